@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Benchmark of `setup.py build_ext` with and without --parallel, as used by
+PythonRecipe and CythonRecipe: builds synthetic C extensions with the host
+compiler, serially then on all the cores, and fails if the parallel build
+isn't at least --min-speedup times faster.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SETUP = """
+from setuptools import setup, Extension
+setup(name="bench", ext_modules=[
+    Extension("bench.m%d" % i, ["m%d.c" % i]) for i in range(COUNT)])
+"""
+
+SOURCE = """
+#include <Python.h>
+%s
+static struct PyModuleDef module = {PyModuleDef_HEAD_INIT, "m%d", NULL, -1, NULL};
+PyMODINIT_FUNC PyInit_m%d(void) { return PyModule_Create(&module); }
+"""
+
+# enough code to keep the optimizer busy for a while
+FUNCTION = """
+int f%d(int *a, int n) {
+    int s = 0;
+    for (int i = 0; i < n; i++) { s += a[i] * %d; s ^= s << 3; }
+    return s;
+}
+"""
+
+
+def make_project(directory, count, functions):
+    with open(os.path.join(directory, "setup.py"), "w") as fd:
+        fd.write(SETUP.replace("COUNT", str(count)))
+    for i in range(count):
+        body = "".join(FUNCTION % (j, j) for j in range(functions))
+        with open(os.path.join(directory, "m{}.c".format(i)), "w") as fd:
+            fd.write(SOURCE % (body, i, i))
+
+
+def build(directory, jobs):
+    build_dir = tempfile.mkdtemp(dir=directory)
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "setup.py", "build_ext", "--parallel={}".format(jobs),
+         "--build-temp", build_dir, "--build-lib", build_dir],
+        cwd=directory, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--extensions", type=int, default=32)
+    parser.add_argument("--functions", type=int, default=400)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--min-speedup", type=float, default=1.3,
+                        help="minimal speedup expected with several jobs")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        make_project(directory, args.extensions, args.functions)
+        serial = build(directory, 1)
+        parallel = build(directory, args.jobs)
+    print("{} extensions, 1 job: {:.2f}s".format(args.extensions, serial))
+    print("{} extensions, {} jobs: {:.2f}s".format(
+        args.extensions, args.jobs, parallel))
+    speedup = serial / parallel
+    print("Speedup: {:.2f}x".format(speedup))
+    if args.jobs < 2:
+        print("A single job, the speedup can't be checked")
+    elif speedup < args.min_speedup:
+        print("The parallel build_ext is slower than expected (< {:.2f}x)".format(
+            args.min_speedup))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
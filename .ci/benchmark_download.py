@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Benchmark of Recipe.download_file against a local HTTP server that throttles
+each connection, like the hosts serving the large archives often do.
+Compares a single stream with segmented downloads.
+"""
+import argparse
+import http.server
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kivy_ios.toolchain import Recipe  # noqa: E402
+
+
+class ThrottledHandler(http.server.BaseHTTPRequestHandler):
+    data = b""
+    rate = 0
+
+    def log_message(self, *args):
+        pass
+
+    def send_data(self, send_body):
+        start, end = 0, len(self.data) - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = int(match.group(2))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                start, end, len(self.data)))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if not send_body:
+            return
+        chunk_size = 64 * 1024
+        for offset in range(start, end + 1, chunk_size):
+            self.wfile.write(self.data[offset:min(offset + chunk_size, end + 1)])
+            time.sleep(chunk_size / self.rate)
+
+    def do_HEAD(self):
+        self.send_data(False)
+
+    def do_GET(self):
+        self.send_data(True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=32, help="archive size in MB")
+    parser.add_argument("--rate", type=float, default=8, help="MB/s per connection")
+    parser.add_argument("--connections", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    ThrottledHandler.data = os.urandom(args.size * 1024 * 1024)
+    ThrottledHandler.rate = args.rate * 1024 * 1024
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ThrottledHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/archive.zip".format(server.server_port)
+
+    recipe = Recipe()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        reference = None
+        for connections in args.connections:
+            filename = os.path.join(tmp_dir, "archive-{}.zip".format(connections))
+            start = time.perf_counter()
+            recipe.download_file(url, filename, connections=connections,
+                                 report_hook=lambda received, size: None)
+            duration = time.perf_counter() - start
+            reference = reference or duration
+            print("{} connection(s): {:.2f}s ({:.1f}x)".format(
+                connections, duration, reference / duration))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Continuous Integration helper script.
+Runs fetch_recipes on stub recipes served by a local HTTP server, and checks
+the downloaded archives, the aggregated progress and the archive_root keys
+of the state.
+"""
+import functools
+import hashlib
+import http.server
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import threading
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kivy_ios import toolchain  # noqa: E402
+from kivy_ios.toolchain import StateStore, fetch_recipes  # noqa: E402
+
+# name: (dependencies, size of the archived file)
+RECIPES = {
+    "fetch_app": (["fetch_lib", "fetch_tool"], 1 << 20),
+    "fetch_lib": (["fetch_base"], 3 << 20),
+    "fetch_tool": ([], 1 << 10),
+    "fetch_base": ([], 2 << 20),
+    "fetch_missing": ([], 0),
+}
+
+RECIPE_TEMPLATE = '''from kivy_ios.toolchain import Recipe
+
+
+class StubRecipe(Recipe):
+    version = "1.0"
+    url = "{url}/{name}-{{version}}.tar.gz"
+    depends = {depends!r}
+    sha256 = {sha256!r}
+
+
+recipe = StubRecipe()
+'''
+
+
+class RecordingProgress(toolchain.DownloadProgress):
+    """DownloadProgress keeping every state it shows"""
+    instances = []
+
+    def __init__(self, count):
+        super().__init__(count)
+        self.shown = []
+        self.instances.append(self)
+
+    def show(self):
+        received = sum(read for read, size in self.sizes.values())
+        self.shown.append((self.done, received))
+        super().show()
+
+
+def make_archive(directory, name, size):
+    """Write <name>-1.0.tar.gz with a single file of `size` random bytes,
+    return its sha256."""
+    fn = os.path.join(directory, "{}-1.0.tar.gz".format(name))
+    with tarfile.open(fn, "w:gz") as archive:
+        info = tarfile.TarInfo("{}-1.0/data.bin".format(name))
+        info.size = size
+        archive.addfile(info, io.BytesIO(os.urandom(size)))
+    with open(fn, "rb") as fd:
+        return hashlib.sha256(fd.read()).hexdigest()
+
+
+def serve(directory):
+    class QuietHandler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}".format(server.server_port)
+
+
+def make_ctx(top, recipes_dir):
+    return SimpleNamespace(
+        root_dir=os.path.dirname(toolchain.__file__),
+        custom_recipes_paths=[
+            os.path.join(recipes_dir, name) for name in RECIPES],
+        cache_dir=os.path.join(top, "cache"),
+        state=StateStore(os.path.join(top, "state.db")),
+        download_connections=4)
+
+
+def main():
+    top = tempfile.mkdtemp()
+    www_dir = os.path.join(top, "www")
+    recipes_dir = os.path.join(top, "recipes")
+    os.makedirs(www_dir)
+    server, url = serve(www_dir)
+    for name, (depends, size) in RECIPES.items():
+        sha256 = None
+        if name != "fetch_missing":
+            sha256 = make_archive(www_dir, name, size)
+        os.makedirs(os.path.join(recipes_dir, name))
+        with open(os.path.join(recipes_dir, name, "__init__.py"), "w") as fd:
+            fd.write(RECIPE_TEMPLATE.format(
+                url=url, name=name, depends=depends, sha256=sha256))
+    toolchain.DownloadProgress = RecordingProgress
+    ctx = make_ctx(top, recipes_dir)
+    os.makedirs(ctx.cache_dir)
+
+    fetch_recipes(["fetch_app"], ctx, jobs=3)
+    names = [name for name in RECIPES if name != "fetch_missing"]
+    total = 0
+    for name in names:
+        fn = os.path.join(ctx.cache_dir, "{0}-{0}-1.0.tar.gz".format(name))
+        with open(fn, "rb") as fd, open(os.path.join(
+                www_dir, "{}-1.0.tar.gz".format(name)), "rb") as expected:
+            assert fd.read() == expected.read(), name
+        total += os.path.getsize(fn)
+        assert not os.path.exists(fn + ".part"), name
+        assert ctx.state["{}.archive_root".format(name)] == (
+            "{}-1.0".format(name))
+    progress = RecordingProgress.instances[-1]
+    assert progress.count == len(names)
+    assert progress.shown[-1] == (len(names), total), progress.shown[-1]
+    for previous, current in zip(progress.shown, progress.shown[1:]):
+        assert current[0] >= previous[0] and current[1] >= previous[1]
+    print("Fetched {} archives ({} bytes) with {} progress updates".format(
+        len(names), total, len(progress.shown)))
+
+    # everything is in the cache now
+    fetch_recipes(["fetch_app"], ctx, jobs=3)
+    assert RecordingProgress.instances[-1].count == 0
+
+    try:
+        fetch_recipes(["fetch_missing"], ctx)
+        raise AssertionError("the missing archive wasn't reported")
+    except SystemExit as e:
+        assert e.code == 1
+    assert "fetch_missing.archive_root" not in ctx.state
+    server.shutdown()
+    print("fetch_recipes OK")
+
+
+if __name__ == "__main__":
+    main()
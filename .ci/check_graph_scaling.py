@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Continuous Integration helper script.
+Checks that the dependency graph planner (topological order, layers and
+critical path) is correct and scales linearly, on synthetic graphs of
+thousands of recipes.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kivy_ios.toolchain import Graph  # noqa: E402
+
+
+def make_graph(size, max_depends, seed=0):
+    """A random DAG: each recipe depends on up to `max_depends` recipes
+    created before it."""
+    rnd = random.Random(seed)
+    graph = Graph()
+    for index in range(size):
+        name = "recipe{}".format(index)
+        graph.add(name, name)
+        for _ in range(rnd.randint(0, max_depends)):
+            if index:
+                graph.add(name, "recipe{}".format(rnd.randrange(index)))
+    return graph
+
+
+def check(graph):
+    position = {}
+    for index, layer in enumerate(graph.layers()):
+        for name in layer:
+            position[name] = index
+    assert len(position) == len(graph.graph)
+    order = list(graph.find_order())
+    seen = set()
+    for name in order:
+        assert graph.graph[name] <= seen, name
+        seen.add(name)
+    lengths = graph.critical_path()
+    for name, deps in graph.graph.items():
+        for dep in deps:
+            assert position[dep] < position[name]
+            assert lengths[dep] > lengths[name]
+
+
+def measure(graph, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        list(graph.find_order())
+        graph.critical_path()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--max-depends", type=int, default=5)
+    parser.add_argument("--max-ratio", type=float, default=3.,
+                        help="allowed slowdown compared to a linear scaling")
+    args = parser.parse_args()
+
+    cycle = Graph()
+    cycle.add("a", "b")
+    cycle.add("b", "a")
+    try:
+        cycle.layers()
+        raise AssertionError("the cycle wasn't detected")
+    except ValueError:
+        pass
+
+    sizes = (2000, 4000, 8000, 16000)
+    timings = []
+    for size in sizes:
+        graph = make_graph(size, args.max_depends)
+        check(graph)
+        timings.append(measure(graph))
+        print("{:>6} recipes: {:.3f}s".format(size, timings[-1]))
+    ratio = (timings[-1] / timings[0]) / (sizes[-1] / sizes[0])
+    print("Slowdown compared to linear scaling: {:.2f}".format(ratio))
+    if ratio > args.max_ratio:
+        print("The graph planner doesn't scale linearly")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
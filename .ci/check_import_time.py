@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Continuous Integration helper script.
+Checks that importing the toolchain and the recipes stays cheap: it must not
+run any command (PATH is emptied, so any sh call fails), must not import the
+modules only needed by some commands, and must stay under a time budget.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# only imported by the commands that need them
+LAZY_MODULES = [
+    "pbxproj", "tarfile", "zipfile", "urllib.request", "multiprocessing",
+    "requests", "cookiecutter",
+]
+
+CHILD = """
+import json, sys, time
+from os import listdir
+from os.path import isdir, join
+before = set(sys.modules)
+start = time.perf_counter()
+import kivy_ios.toolchain
+toolchain_time = time.perf_counter() - start
+recipes_dir = join(kivy_ios.toolchain.curdir, "recipes")
+for name in sorted(listdir(recipes_dir)):
+    if isdir(join(recipes_dir, name)) and name != "__pycache__":
+        __import__("kivy_ios.recipes.{}".format(name))
+total_time = time.perf_counter() - start
+print(json.dumps({
+    "toolchain": toolchain_time,
+    "total": total_time,
+    "modules": sorted(set(sys.modules) - before),
+}))
+"""
+
+
+def measure(root_dir):
+    with tempfile.TemporaryDirectory() as empty_dir:
+        env = dict(os.environ, PATH=empty_dir, PYTHONPATH=root_dir)
+        output = subprocess.run(
+            [sys.executable, "-c", CHILD], env=env, cwd=empty_dir,
+            check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--max-seconds", type=float, default=0.5,
+                        help="budget for importing the toolchain and all the recipes")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = [measure(root_dir) for _ in range(args.runs)]
+    best = min(results, key=lambda result: result["total"])
+    print("import kivy_ios.toolchain: {:.3f}s".format(best["toolchain"]))
+    print("import toolchain and recipes: {:.3f}s".format(best["total"]))
+
+    loaded = [
+        module for module in LAZY_MODULES
+        if module in best["modules"]]
+    if loaded:
+        sys.exit("Imported at import time: {}".format(", ".join(loaded)))
+    if best["total"] > args.max_seconds:
+        sys.exit("Import took more than {}s".format(args.max_seconds))
+
+
+if __name__ == "__main__":
+    main()
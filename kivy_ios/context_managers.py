@@ -4,6 +4,7 @@ kivy-ios builds.
 """
 from logging import getLogger
 from contextlib import contextmanager
+import fcntl
 from os import getcwd, chdir, environ
 from os.path import expanduser
 
@@ -44,3 +45,17 @@ def python_path(newdir):
             environ.pop("PYTHONPATH")
         else:
             environ["PYTHONPATH"] = prevdir
+
+
+@contextmanager
+def file_lock(filename):
+    """
+    Hold an exclusive lock on `filename` for the duration of the context. The
+    lock is shared between processes, the file is created if needed.
+    """
+    with open(filename, "a") as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
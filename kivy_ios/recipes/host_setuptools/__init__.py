@@ -9,6 +9,8 @@ class HostSetuptools(Recipe):
     depends = ["openssl", "hostpython"]
     archs = ["x86_64"]
     url = "setuptools"
+    # the scripts have the absolute path of hostpython in their shebang
+    relocatable = False
 
     def prebuild_arch(self, arch):
         hostpython = sh.Command(self.ctx.hostpython)
@@ -8,6 +8,8 @@ class HostSetuptools3(Recipe):
     archs = ["x86_64"]
     version = '54.1.2'
     url = 'https://pypi.python.org/packages/source/s/setuptools/setuptools-{version}.tar.gz'
+    # the scripts have the absolute path of hostpython in their shebang
+    relocatable = False
 
     @cache_execution
     def install(self):
@@ -1,6 +1,7 @@
 from kivy_ios.toolchain import Recipe, shprint
 import sh
-from os.path import exists
+from os.path import exists, join
+import shutil
 import logging
 
 logger = logging.getLogger(__name__)
@@ -22,6 +23,9 @@ class LibffiRecipe(Recipe):
         for arch in self.filtered_archs:
             self.build(arch)
 
+        with self.dist_writer():
+            self.install_all()
+
         # since we don't run cache_execution, call this here for `status`
         self.update_state("{}.build_all".format(self.name), True)
 
@@ -55,7 +59,7 @@ class LibffiRecipe(Recipe):
                 self.ctx.concurrent_xcodebuild,
                 "ONLY_ACTIVE_ARCH=NO",
                 "ARCHS={}".format(arch.arch),
-                "DSTROOT={}/hostlibffi".format(self.ctx.dist_dir),
+                "DSTROOT={}".format(join(self.build_dir, "dstroot")),
                 "-sdk", "macosx",
                 "clean", "build", "installhdrs", "install",
                 "-project", "libffi.xcodeproj",
@@ -65,5 +69,14 @@ class LibffiRecipe(Recipe):
     def postbuild_arch(self, arch):
         pass
 
+    def install_all(self):
+        # the xcodebuild install is done in the build directory, to only
+        # write into dist/ under the dist lock
+        for arch in self.filtered_archs:
+            shutil.copytree(
+                join(self.get_build_dir(arch.arch), "dstroot"),
+                join(self.ctx.dist_dir, "hostlibffi"),
+                symlinks=True, dirs_exist_ok=True)
+
 
 recipe = LibffiRecipe()
@@ -17,6 +17,8 @@ class Hostpython3Recipe(Recipe):
     optional_depends = []
     archs = ["x86_64"]
     build_subdir = 'native-build'
+    # the install prefix is compiled in
+    relocatable = False
 
     def init_with_ctx(self, ctx):
         super().init_with_ctx(ctx)
@@ -96,7 +96,8 @@ class KiventCoreRecipe(CythonRecipe):
         logger.info("DISTDIR", self.ctx.dist_dir)
         logger.info("ARCH KIVY LOC", self.get_recipe('kivy', self.ctx).get_build_dir(arch.arch))
 
-        shprint(hostpython, setup_path, "build_ext", "install", _env=build_env)
+        shprint(hostpython, setup_path, "build_ext",
+                self.ctx.concurrent_build_ext, "install", _env=build_env)
 
 
 recipe = KiventCoreRecipe()
@@ -59,6 +59,7 @@ class PillowRecipe(CythonRecipe):
             "--disable-lcms",
             "--disable-platform-guessing",
             "-g",
+            self.ctx.concurrent_build_ext,
             _env=build_env,
         )
         self.biglink()
@@ -15,6 +15,8 @@ class Python3Recipe(Recipe):
     depends = ["hostpython3", "libffi", "openssl"]
     library = "libpython3.9.a"
     pbx_libraries = ["libz", "libbz2", "libsqlite3"]
+    # the install prefix is compiled in
+    relocatable = False
 
     def init_with_ctx(self, ctx):
         super().init_with_ctx(ctx)
@@ -9,53 +9,314 @@ This tool intend to replace all the previous tools/ in shell script.
 import argparse
 import sys
 from sys import stdout
-from os.path import join, dirname, realpath, exists, isdir, basename
-from os import listdir, unlink, makedirs, environ, chdir, getcwd, walk
+from os.path import (
+    join, dirname, realpath, exists, isdir, basename, islink, relpath,
+    expanduser, normpath, isabs)
+from os import (
+    listdir, unlink, makedirs, environ, chdir, getcwd, walk, lstat, replace,
+    getpid, readlink, stat, chmod, symlink, link, utime)
+from stat import S_ISLNK
+from functools import partial
+from urllib.parse import urlparse
 import sh
-import zipfile
-import tarfile
 import importlib
 import io
 import json
 import shutil
 import fnmatch
-import tempfile
 import time
-from contextlib import suppress
-from datetime import datetime
+import hashlib
+import sqlite3
+import threading
+import queue
+from collections import deque
+from contextlib import suppress, contextmanager
+from datetime import datetime, timedelta
 from pprint import pformat
 import logging
-from urllib.request import FancyURLopener, urlcleanup
-from pbxproj import XcodeProject
-from pbxproj.pbxextensions.ProjectFiles import FileOptions
+from kivy_ios.context_managers import file_lock
 
 curdir = dirname(__file__)
 
 initial_working_directory = getcwd()
 
+# per-user cache, shared by all the builds
+user_cache_dir = join(expanduser("~"), ".cache", "kivy-ios")
+
 # For more detailed logging, use something like
 # format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:%(funcName)s():%(lineno)d] %(message)s'
+# The debug messages only go to the build logs (see BuildLog)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
 logging.basicConfig(format='[%(levelname)-8s] %(message)s',
                     datefmt='%Y-%m-%d:%H:%M:%S',
-                    level=logging.DEBUG)
+                    level=logging.DEBUG,
+                    handlers=[console_handler])
 
 # Quiet the loggers we don't care about
 sh_logging = logging.getLogger('sh')
 sh_logging.setLevel(logging.WARNING)
+logging.getLogger('urllib3').setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
 
 def shprint(command, *args, **kwargs):
-    kwargs["_iter"] = True
-    kwargs["_out_bufsize"] = 1
+    name = " ".join([basename(str(command))] + [str(arg) for arg in args])
+    with BuildTrace.span(name, "command", recipe=BuildTrace.recipe):
+        _shprint(command, *args, **kwargs)
+
+
+def _shprint(command, *args, **kwargs):
+    log = BuildLog.current
+    if log is None:
+        kwargs["_iter"] = True
+        kwargs["_out_bufsize"] = 1
+        kwargs["_err_to_out"] = True
+        logger.info("Running Shell: {} {}".format(str(command), args))
+        cmd = command(*args, **kwargs)
+        for line in cmd:
+            # strip only last CR:
+            line_str = "\n".join(line.encode("ascii", "replace").decode().splitlines())
+            logger.info(line_str)
+        return
+
+    # the command and its output only go to the log file, the last lines are
+    # shown if the command fails. Only the variables set for the command are
+    # logged, not the whole environment.
+    env = kwargs.get("_env") or {}
+    log.write("$ {} {}\n  in {}\n".format(str(command), args, getcwd()))
+    for key in sorted(env):
+        if environ.get(key) != env[key]:
+            log.write("  {}={}\n".format(key, env[key]))
+    tail = deque(maxlen=BuildLog.tail_size)
+
+    def on_output(chunk):
+        log.write(chunk)
+        tail.append(chunk)
+
+    kwargs["_out"] = on_output
+    kwargs["_out_bufsize"] = 64 * 1024
     kwargs["_err_to_out"] = True
-    logger.info("Running Shell: {} {} {}".format(str(command), args, kwargs))
-    cmd = command(*args, **kwargs)
-    for line in cmd:
-        # strip only last CR:
-        line_str = "\n".join(line.encode("ascii", "replace").decode().splitlines())
-        logger.debug(line_str)
+    kwargs["_no_out"] = True
+    kwargs["_decode_errors"] = "replace"
+    try:
+        command(*args, **kwargs)
+    except sh.ErrorReturnCode as e:
+        lines = "".join(tail).splitlines()[-BuildLog.tail_size:]
+        logger.error("Command failed with exit code {}, see {}".format(
+            e.exit_code, log.filename))
+        logger.error("Last lines of output:\n{}".format("\n".join(lines)))
+        raise
+
+
+class BuildLog:
+    """Log file receiving the raw output of the commands run for a recipe,
+    or one of its archs, in build/logs/. It is written by a background
+    thread, so the output of verbose builds doesn't slow them down.
+    """
+    # log of the recipe being built by this process
+    current = None
+    compress = False
+    tail_size = 40
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.queue = queue.Queue()
+        self.thread = None
+
+    @classmethod
+    @contextmanager
+    def open(cls, ctx, name):
+        logs_dir = join(ctx.build_dir, "logs")
+        ensure_dir(logs_dir)
+        ext = ".log.gz" if cls.compress else ".log"
+        log = cls(join(logs_dir, name + ext))
+        log.start()
+        previous, cls.current = cls.current, log
+        try:
+            yield log
+        finally:
+            cls.current = previous
+            log.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.write("==== {} (pid {})\n".format(datetime.now(), getpid()))
+
+    def write(self, data):
+        self.queue.put(data)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        if self.filename.endswith(".gz"):
+            import gzip
+            fd = gzip.open(self.filename, "at")
+        else:
+            fd = open(self.filename, "a")
+        with fd:
+            while True:
+                data = self.queue.get()
+                if data is None:
+                    break
+                fd.write(data)
+
+
+class BuildLogHandler(logging.Handler):
+    """Write the log messages, debug ones included, to the current build
+    log"""
+
+    def emit(self, record):
+        log = BuildLog.current
+        if log is not None:
+            log.write(self.format(record) + "\n")
+
+
+def console_filter(record):
+    """While a recipe log is open, only show its progress lines, the
+    warnings and the errors on the console"""
+    return (BuildLog.current is None or record.levelno >= logging.WARNING
+            or getattr(record, "progress", False))
+
+
+def log_progress(message):
+    """Log `message` on the console, even while a recipe log is open"""
+    logger.info(message, extra={"progress": True})
+
+
+console_handler.addFilter(console_filter)
+_build_log_handler = BuildLogHandler()
+_build_log_handler.setFormatter(logging.Formatter('[%(levelname)-8s] %(message)s'))
+logging.getLogger().addHandler(_build_log_handler)
+
+
+class BuildTrace:
+    """Timings of the build steps and commands, appended as JSON lines to
+    build/trace.jsonl by every build process, and exported at the end of
+    the build as a Chrome trace (chrome://tracing, Perfetto) and a summary.
+    """
+    filename = None
+    # recipe being built by this process
+    recipe = None
+
+    @classmethod
+    def start(cls, ctx):
+        cls.filename = join(ctx.build_dir, "trace.jsonl")
+        ensure_dir(ctx.build_dir)
+        with open(cls.filename, "w"):
+            pass
+
+    @classmethod
+    @contextmanager
+    def span(cls, name, cat, **args):
+        start = time.time()
+        try:
+            yield args
+        finally:
+            if cls.filename:
+                cls.add(name, cat, start, time.time(), args)
+
+    @classmethod
+    def add(cls, name, cat, start, end, args):
+        event = {
+            "name": name, "cat": cat, "ph": "X",
+            "ts": int(start * 1e6), "dur": int((end - start) * 1e6),
+            "pid": getpid(), "tid": threading.get_ident(), "args": args}
+        # a single write in append mode, the processes don't mix their lines
+        with open(cls.filename, "a") as fd:
+            fd.write(json.dumps(event) + "\n")
+
+    @staticmethod
+    def load(filename):
+        events = []
+        with open(filename) as fd:
+            for line in fd:
+                with suppress(ValueError):
+                    events.append(json.loads(line))
+        return events
+
+    @classmethod
+    def export(cls, ctx):
+        events = cls.load(cls.filename)
+        with open(join(ctx.build_dir, "trace.json"), "w") as fd:
+            json.dump({"traceEvents": events}, fd)
+        with open(join(ctx.build_dir, "trace-summary.json"), "w") as fd:
+            json.dump(cls.summarize(events), fd, indent=2)
+
+    @staticmethod
+    def summarize(events):
+        """Return the wall time of the build, and of each recipe, step and
+        command, sorted by decreasing duration.
+        """
+        def ranked(category):
+            items = [{"name": event["name"], "seconds": event["dur"] / 1e6,
+                      "recipe": event["args"].get("recipe")}
+                     for event in events if event["cat"] == category]
+            return sorted(items, key=lambda item: -item["seconds"])
+
+        if events:
+            start = min(event["ts"] for event in events)
+            end = max(event["ts"] + event["dur"] for event in events)
+        else:
+            start = end = 0
+        return {
+            "seconds": (end - start) / 1e6,
+            "recipes": ranked("recipe"),
+            "steps": ranked("step"),
+            "commands": ranked("command")}
+
+
+class BuildHistory:
+    """Wall time of the recipes, and of each of their archs, in the previous
+    builds. It is kept in the user cache, to schedule the longest recipes
+    first and estimate the build time.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.durations = {}
+        with suppress(OSError, ValueError):
+            with open(filename) as fd:
+                self.durations = json.load(fd)
+
+    def record(self, name, seconds):
+        previous = self.durations.get(name)
+        # smooth the variations between two builds
+        if previous is not None:
+            seconds = (previous + seconds) / 2.
+        self.durations[name] = seconds
+
+    def record_trace(self, events):
+        """Record the recipes and archs actually built in a build trace
+        """
+        for event in events:
+            seconds = event["dur"] / 1e6
+            recipe = event["args"].get("recipe")
+            if event["cat"] == "recipe":
+                if not event["args"].get("cached"):
+                    self.record(recipe, seconds)
+            elif (event["cat"] == "step" and recipe
+                    and event["name"].startswith(recipe + ".build.")):
+                arch = event["name"][len(recipe) + 7:]
+                self.record("{}/{}".format(recipe, arch), seconds)
+
+    def get_weights(self, names):
+        """Return the expected duration of each of the `names` recipes. The
+        recipes never built count for the average duration.
+        """
+        known = [seconds for name, seconds in self.durations.items()
+                 if "/" not in name]
+        default = sum(known) / len(known) if known else 1.
+        return {name: self.durations.get(name, default) for name in names}
+
+    def save(self):
+        ensure_dir(dirname(self.filename))
+        with open(self.filename + ".tmp", "w") as fd:
+            json.dump(self.durations, fd, indent=2, sort_keys=True)
+        replace(self.filename + ".tmp", self.filename)
 
 
 def cache_execution(f):
@@ -66,12 +327,24 @@ def cache_execution(f):
         if args:
             for arg in args:
                 key += ".{}".format(arg)
-        if key in state and not force:
-            logger.debug("Cached result: {} {}. Ignoring".format(f.__name__.capitalize(), self.name))
-            return
+        fingerprint = self.get_step_fingerprint(f.__name__)
+        value = state.get(key)
+        if value is not None and not force:
+            if value == fingerprint:
+                logger.debug("Cached result: {} {}. Ignoring".format(f.__name__.capitalize(), self.name))
+                return
+            if value is True and self.is_legacy_step_valid(f.__name__):
+                # recorded before the fingerprints, adopt its result
+                logger.debug("Cached result: {} {}. Ignoring".format(f.__name__.capitalize(), self.name))
+                self.update_state(key, fingerprint)
+                return
+            logger.info("{} {}: the inputs changed since the last run".format(
+                f.__name__.capitalize(), self.name))
+            self.invalidate_step(f.__name__, *args)
         logger.info("{} {}".format(f.__name__.capitalize(), self.name))
-        f(self, *args, **kwargs)
-        self.update_state(key, True)
+        with BuildTrace.span(key, "step", recipe=self.name):
+            f(self, *args, **kwargs)
+        self.update_state(key, fingerprint)
     return _cache_execution
 
 
@@ -85,65 +358,512 @@ def remove_junk(d):
                 unlink(join(root, fn))
 
 
-class ChromeDownloader(FancyURLopener):
-    version = (
-        'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
-        '(KHTML, like Gecko) Chrome/28.0.1500.71 Safari/537.36')
+def snapshot_tree(d, exclude=()):
+    """Return the files and symlinks of `d` with their size and mtime,
+    keyed by their path relative to `d`.
+    """
+    snapshot = {}
+    for root, dirnames, filenames in walk(d):
+        links = [dn for dn in dirnames if islink(join(root, dn))]
+        for fn in filenames + links:
+            path = join(root, fn)
+            rel = relpath(path, d)
+            if rel in exclude:
+                continue
+            st = lstat(path)
+            snapshot[rel] = (st.st_size, st.st_mtime_ns)
+    return snapshot
+
+
+def sha256_file(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def diff_snapshot(before, after):
+    """Return the paths changed and removed between two snapshots"""
+    changed = {rel for rel, st in after.items() if before.get(rel) != st}
+    removed = set(before) - set(after)
+    return changed, removed
+
+
+_http_session = (None, None)
+
+download_user_agent = (
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/28.0.1500.71 Safari/537.36')
 
 
-urlretrieve = ChromeDownloader().retrieve
+def get_http_session():
+    """Return the HTTP session used for the downloads of this process, so
+    that connections to the same hosts are reused.
+    """
+    global _http_session
+    pid, session = _http_session
+    if pid != getpid():
+        # requests is slow to import, only do it for downloads
+        import requests
+        session = requests.Session()
+        session.headers["User-Agent"] = download_user_agent
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=16)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _http_session = (getpid(), session)
+    return session
+
+
+def is_client_error(e):
+    """Tell if the download error `e` is an HTTP error that retrying won't
+    fix: 4xx, except 408 (request timeout) and 429 (too many requests).
+    """
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+
+def iter_raw_content(resp, chunk_size=1 << 16):
+    """Iterate over the body of a streamed response as sent by the server:
+    a Content-Encoding is not decoded, so the file is the one the server has
+    and Content-Length counts its bytes.
+    """
+    from urllib3.exceptions import HTTPError
+    try:
+        yield from resp.raw.stream(chunk_size, decode_content=False)
+    except HTTPError as e:
+        raise IOError(e)
+
+
+class ArchiveExtractor:
+    """Extract tar and zip archives in-process.
+
+    The archive is read in order by the calling thread and the files are
+    written by a thread pool, with their mode and mtime (autotools based
+    builds rely on them). Members whose path or link target would end up
+    outside of `dest` are refused.
+    """
+
+    def __init__(self, dest, workers=4):
+        ensure_dir(dest)
+        self.dest = realpath(dest)
+        self.workers = max(1, workers)
+        self.count = 0
+        self.size = 0
+        self.has_symlinks = False
+        # real paths of the directories `..` is applied to in link targets
+        self._parent_dirs = set()
+        self._local = threading.local()
+
+    def _is_inside(self, path):
+        return path == self.dest or path.startswith(self.dest + "/")
+
+    def _get_path(self, name):
+        path = normpath(join(self.dest, name))
+        if isabs(name) or not self._is_inside(path):
+            raise ValueError("Unsafe path in archive: {}".format(name))
+        if self.has_symlinks:
+            # a directory of the path may be a link extracted before
+            if not self._is_inside(realpath(dirname(path))):
+                raise ValueError("Unsafe path in archive: {}".format(name))
+            if islink(path):
+                unlink(path)
+        return path
+
+    def _symlink(self, path, target):
+        # the target is resolved through the links already extracted, and a
+        # link can't replace a directory that a previous target goes up from
+        # (`a -> b/..` then `b -> .` would make `a` point to the parent)
+        real_path = join(realpath(dirname(path)), basename(path))
+        if (isabs(target)
+                or not self._is_inside(normpath(join(dirname(path), target)))
+                or not self._is_inside(realpath(join(dirname(path), target)))
+                or any(d == real_path or d.startswith(real_path + "/")
+                       for d in self._parent_dirs)):
+            raise ValueError("Unsafe link in archive: {} -> {}".format(
+                path, target))
+        d = dirname(path)
+        for part in target.split("/"):
+            if part == "..":
+                self._parent_dirs.add(realpath(d))
+                d = dirname(d)
+            elif part not in ("", "."):
+                d = join(d, part)
+        ensure_dir(dirname(path))
+        with suppress(FileNotFoundError):
+            unlink(path)
+        symlink(target, path)
+        self.has_symlinks = True
+
+    def _write(self, path, data, mode, mtime):
+        if callable(data):
+            data = data()
+        with open(path, "wb") as fd:
+            fd.write(data)
+        chmod(path, mode & 0o777)
+        utime(path, (mtime, mtime))
+
+    def _submit(self, executor, pending, path, data, mode, mtime):
+        ensure_dir(dirname(path))
+        self.count += 1
+        pending.append(executor.submit(self._write, path, data, mode, mtime))
+        if len(pending) >= self.workers * 16:
+            # don't keep too many members in memory
+            for future in pending:
+                future.result()
+            del pending[:]
+
+    def extract(self, filename, decompressor=None):
+        """Extract `filename`. For tarballs, `decompressor` can be the path
+        of a parallel implementation of gzip or bzip2 (pigz, pbzip2).
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        pending = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            if filename.endswith(".zip"):
+                self._extract_zip(filename, executor, pending)
+            else:
+                self._extract_tar(filename, decompressor, executor, pending)
+            for future in pending:
+                future.result()
+
+    def _extract_tar(self, filename, decompressor, executor, pending):
+        import subprocess
+        import tarfile
+        process = None
+        if decompressor:
+            process = subprocess.Popen(
+                [decompressor, "-dc", filename], stdout=subprocess.PIPE)
+            archive = tarfile.open(fileobj=process.stdout, mode="r|")
+        else:
+            archive = tarfile.open(filename, mode="r|*")
+        hardlinks = []
+        with archive:
+            for member in archive:
+                path = self._get_path(member.name)
+                if member.isdir():
+                    ensure_dir(path)
+                elif member.issym():
+                    self._symlink(path, member.linkname)
+                elif member.islnk():
+                    hardlinks.append((path, self._get_path(member.linkname)))
+                elif member.isreg():
+                    data = archive.extractfile(member).read()
+                    self.size += len(data)
+                    self._submit(executor, pending, path, data,
+                                 member.mode, member.mtime)
+                else:
+                    logger.debug("Skipping special file {}".format(member.name))
+        if process is not None and process.wait() != 0:
+            raise Exception("{} failed to decompress {}".format(
+                decompressor, filename))
+        # the targets must be written before linking to them
+        for future in pending:
+            future.result()
+        del pending[:]
+        for path, target in hardlinks:
+            ensure_dir(dirname(path))
+            with suppress(FileNotFoundError):
+                unlink(path)
+            link(target, path)
+            self.count += 1
+
+    def _read_zip_member(self, filename, name):
+        # one ZipFile per thread, they can't be shared
+        archives = self._local.__dict__.setdefault("archives", {})
+        if filename not in archives:
+            import zipfile
+            archives[filename] = zipfile.ZipFile(filename)
+        return archives[filename].read(name)
+
+    def _extract_zip(self, filename, executor, pending):
+        import zipfile
+        with zipfile.ZipFile(filename) as archive:
+            infos = archive.infolist()
+            for info in infos:
+                path = self._get_path(info.filename)
+                mode = info.external_attr >> 16
+                if info.filename.endswith("/"):
+                    ensure_dir(path)
+                elif S_ISLNK(mode):
+                    self._symlink(path, archive.read(info).decode("utf-8"))
+                else:
+                    mtime = time.mktime(info.date_time + (0, 0, -1))
+                    self.size += info.file_size
+                    self._submit(
+                        executor, pending, path,
+                        partial(self._read_zip_member, filename, info.filename),
+                        mode or 0o644, mtime)
+
 
+class StateStore:
+    """Key/value store of the build state, backed by SQLite in WAL mode.
 
-class JsonStore:
-    """Replacement of shelve using json, needed for support python 2 and 3.
+    Every change is atomic and only touches its own key. Changes made within
+    `transaction()` are committed together. Several processes can use the
+    same store: each thread of each process opens its own connection. An
+    existing state.db in the former json format is imported on first use.
     """
 
     def __init__(self, filename):
         self.filename = filename
-        self.data = {}
+        self._local = threading.local()
+        # every connection opened, as a connection inherited through a fork
+        # must not be closed by the child, even by the garbage collector
+        self._connections = []
+        data = None
         if exists(filename):
-            try:
-                with io.open(filename, encoding='utf-8') as fd:
-                    self.data = json.load(fd)
-            except ValueError:
-                logger.warning("Unable to read the state.db, content will be replaced.")
+            with open(filename, "rb") as fd:
+                is_sqlite = fd.read(16) == b"SQLite format 3\0"
+            if not is_sqlite:
+                try:
+                    with io.open(filename, encoding='utf-8') as fd:
+                        data = json.load(fd)
+                except ValueError:
+                    logger.warning("Unable to read the state.db, content will be replaced.")
+                replace(filename, filename + ".json")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS state "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        if data:
+            logger.info("Importing the state.db json content")
+            with self.transaction():
+                for key, value in data.items():
+                    self[key] = value
+
+    @property
+    def conn(self):
+        local = self._local
+        if getattr(local, "pid", None) != getpid():
+            conn = sqlite3.connect(
+                self.filename, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._connections.append(conn)
+            local.conn = conn
+            local.pid = getpid()
+            local.depth = 0
+        return local.conn
+
+    @contextmanager
+    def transaction(self):
+        """Commit all the changes done in the context at once"""
+        conn = self.conn
+        local = self._local
+        if local.depth == 0:
+            conn.execute("BEGIN IMMEDIATE")
+        local.depth += 1
+        try:
+            yield
+        except BaseException:
+            local.depth -= 1
+            if local.depth == 0:
+                conn.execute("ROLLBACK")
+            raise
+        local.depth -= 1
+        if local.depth == 0:
+            conn.execute("COMMIT")
 
     def __getitem__(self, key):
-        return self.data[key]
+        row = self.conn.execute(
+            "SELECT value FROM state WHERE key = ?", (key, )).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
 
     def __setitem__(self, key, value):
-        self.data[key] = value
-        self.sync()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+            (key, json.dumps(value)))
 
     def __delitem__(self, key):
-        del self.data[key]
-        self.sync()
+        cursor = self.conn.execute("DELETE FROM state WHERE key = ?", (key, ))
+        if not cursor.rowcount:
+            raise KeyError(key)
 
     def __contains__(self, item):
-        return item in self.data
+        return self.conn.execute(
+            "SELECT 1 FROM state WHERE key = ?", (item, )).fetchone() is not None
 
     def get(self, item, default=None):
-        return self.data.get(item, default)
+        try:
+            return self[item]
+        except KeyError:
+            return default
 
     def keys(self):
-        return self.data.keys()
+        return [row[0] for row in self.conn.execute("SELECT key FROM state")]
 
     def remove_all(self, prefix):
-        for key in tuple(self.data.keys()):
-            if not key.startswith(prefix):
-                continue
-            del self.data[key]
-        self.sync()
+        self.conn.execute(
+            "DELETE FROM state WHERE substr(key, 1, ?) = ?",
+            (len(prefix), prefix))
 
     def sync(self):
-        with open(self.filename, 'w') as fd:
-            json.dump(self.data, fd, ensure_ascii=False)
+        """Changes are written as they happen, kept for compatibility"""
+        pass
+
+
+class BinaryCache:
+    """Content-addressed store of what the recipes installed into dist/.
+
+    An entry is a tarball of the files a recipe added or changed in dist/,
+    named after the recipe fingerprint, and a json file with the tarball
+    hash, the files the recipe removed and the state keys to restore.
+
+    If `remote_url` is set, missing entries are looked up on that HTTP
+    server, and stored entries are uploaded to it with PUT if `upload` is
+    set.
+    """
+
+    # files of dist/ that don't belong to any recipe
+    exclude = ("state.db", "state.db-wal", "state.db-shm", "state.db.json",
+               ".lock")
+
+    def __init__(self, cache_dir, dist_dir, remote_url=None, upload=False):
+        self.cache_dir = cache_dir
+        self.dist_dir = dist_dir
+        self.remote_url = remote_url
+        self.upload = upload
+
+    def snapshot(self):
+        return snapshot_tree(self.dist_dir, self.exclude)
+
+    def _fn(self, name, key, ext):
+        return join(self.cache_dir, "{}-{}.{}".format(name, key, ext))
+
+    def _url(self, name, key, ext):
+        return "{}/{}-{}.{}".format(self.remote_url.rstrip("/"), name, key, ext)
+
+    def store(self, name, key, changed, removed, state):
+        import tarfile
+        ensure_dir(self.cache_dir)
+        tar_fn = self._fn(name, key, "tar.gz")
+        with tarfile.open(tar_fn + ".tmp", "w:gz") as tf:
+            for rel in sorted(changed):
+                path = join(self.dist_dir, rel)
+                if exists(path) or islink(path):
+                    tf.add(path, arcname=rel, recursive=False)
+        meta = {
+            "sha256": sha256_file(tar_fn + ".tmp"),
+            "removed": sorted(removed),
+            "state": state}
+        with open(self._fn(name, key, "json.tmp"), "w") as fd:
+            json.dump(meta, fd)
+        # the json file is what marks the entry as complete
+        replace(tar_fn + ".tmp", tar_fn)
+        replace(self._fn(name, key, "json.tmp"), self._fn(name, key, "json"))
+        logger.info("Stored {} in the binary cache ({} files)".format(
+            name, len(changed)))
+        if self.remote_url and self.upload:
+            self.push(name, key)
+
+    def _is_inside(self, rel):
+        """Check that `rel` names a path of dist/, even through the links
+        of dist/"""
+        dist_dir = realpath(self.dist_dir)
+        path = normpath(join(dist_dir, rel))
+        parent = realpath(dirname(path))
+        return (not isabs(rel) and path.startswith(dist_dir + "/")
+                and (parent == dist_dir or parent.startswith(dist_dir + "/")))
+
+    def restore(self, name, key):
+        """Restore the entry into dist/, return the state keys to set or
+        None if there is no such entry.
+
+        Entries may come from a remote cache: the paths they remove and
+        extract must stay inside dist/, or the entry is discarded.
+        """
+        meta_fn = self._fn(name, key, "json")
+        if not exists(meta_fn) and not self.fetch(name, key):
+            return
+        with open(meta_fn) as fd:
+            meta = json.load(fd)
+        tar_fn = self._fn(name, key, "tar.gz")
+        try:
+            if not exists(tar_fn) or sha256_file(tar_fn) != meta["sha256"]:
+                raise ValueError("the hash of the tarball doesn't match")
+            for rel in meta["removed"]:
+                if not self._is_inside(rel):
+                    raise ValueError("Unsafe path to remove: {}".format(rel))
+            for rel in meta["removed"]:
+                path = join(self.dist_dir, rel)
+                if isdir(path) and not islink(path):
+                    shutil.rmtree(path)
+                else:
+                    with suppress(FileNotFoundError):
+                        unlink(path)
+            extractor = ArchiveExtractor(self.dist_dir)
+            # dist/ has links of its own, check every path against them
+            extractor.has_symlinks = True
+            extractor.extract(tar_fn)
+        except ValueError as e:
+            logger.warning("Binary cache entry for {} is invalid ({}), "
+                           "removing it".format(name, e))
+            for fn in (meta_fn, tar_fn):
+                with suppress(FileNotFoundError):
+                    unlink(fn)
+            return
+        logger.info("Restored {} from the binary cache".format(name))
+        return meta["state"]
+
+    def fetch(self, name, key):
+        """Download an entry from the remote cache into the local one.
+        Return True if it was found and its hash matches.
+        """
+        if not self.remote_url:
+            return False
+        import requests
+        ensure_dir(self.cache_dir)
+        tar_fn = self._fn(name, key, "tar.gz")
+        try:
+            resp = requests.get(self._url(name, key, "json"), timeout=30)
+            if resp.status_code == 404:
+                logger.info("{} not found in the remote cache".format(name))
+                return False
+            resp.raise_for_status()
+            meta = resp.json()
+            logger.info("Downloading {} from the remote cache".format(name))
+            with requests.get(self._url(name, key, "tar.gz"),
+                              stream=True, timeout=30) as resp:
+                resp.raise_for_status()
+                with open(tar_fn + ".tmp", "wb") as fd:
+                    for chunk in resp.iter_content(chunk_size=1 << 20):
+                        fd.write(chunk)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning("Unable to use the remote cache: {}".format(e))
+            return False
+        if sha256_file(tar_fn + ".tmp") != meta.get("sha256"):
+            logger.warning("Remote cache entry for {} doesn't match its "
+                           "hash, ignoring it".format(name))
+            unlink(tar_fn + ".tmp")
+            return False
+        replace(tar_fn + ".tmp", tar_fn)
+        with open(self._fn(name, key, "json"), "w") as fd:
+            json.dump(meta, fd)
+        return True
+
+    def push(self, name, key):
+        """Upload a local entry to the remote cache"""
+        import requests
+        logger.info("Uploading {} to the remote cache".format(name))
+        try:
+            # the json last, as it marks the entry as complete
+            for ext in ("tar.gz", "json"):
+                with open(self._fn(name, key, ext), "rb") as fd:
+                    resp = requests.put(
+                        self._url(name, key, ext), data=fd, timeout=300)
+                resp.raise_for_status()
+        except requests.RequestException as e:
+            logger.warning("Unable to upload {} to the remote cache: {}".format(
+                name, e))
 
 
 class Arch:
     def __init__(self, ctx):
         self.ctx = ctx
-        self._ccsh = None
+        self._env = None
+        self._env_key = None
 
     def __str__(self):
         return self.arch
@@ -157,17 +877,53 @@ class Arch:
             for d in self.ctx.include_dirs]
 
     def get_env(self):
-        include_dirs = [
-            "-I{}/{}".format(
-                self.ctx.include_dir,
-                d.format(arch=self))
-            for d in self.ctx.include_dirs]
-        include_dirs += ["-I{}".format(
-            join(self.ctx.dist_dir, "include", self.arch))]
+        """Return the build environment of this arch. It is computed once and
+        kept until the include dirs of the context change. The caller gets
+        its own copy.
+        """
+        key = (tuple(self.ctx.include_dirs), environ.get("USE_CCACHE", "1"))
+        if self._env is None or self._env_key != key:
+            self._env = self._build_env()
+            self._env_key = key
+        return dict(self._env)
+
+    @property
+    def sysroot(self):
+        return self.ctx.sdk_paths[self.sdk]
+
+    def invalidate_env(self):
+        self._env = None
+
+    def _write_wrapper(self, name, command):
+        """Write a compiler wrapper script in the build dir, keeping its
+        path and mtime stable while its content doesn't change.
+        """
+        filename = join(self.ctx.build_dir, "wrappers", "{}-{}".format(
+            self.arch, name))
+        content = '#!/bin/sh\n{} "$@"\n'.format(command)
+        with suppress(FileNotFoundError):
+            with open(filename) as fd:
+                if fd.read() == content:
+                    return filename
+        ensure_dir(dirname(filename))
+        tmp_fn = "{}.{}".format(filename, getpid())
+        with open(tmp_fn, "w") as fd:
+            fd.write(content)
+        chmod(tmp_fn, 0o755)
+        replace(tmp_fn, filename)
+        return filename
+
+    def _build_env(self):
+        include_dirs = []
+        for d in self.include_dirs + [join(self.ctx.dist_dir, "include", self.arch)]:
+            flag = "-I{}".format(d)
+            if flag not in include_dirs:
+                include_dirs.append(flag)
 
         env = {}
-        cc = sh.xcrun("-find", "-sdk", self.sdk, "clang").strip()
-        cxx = sh.xcrun("-find", "-sdk", self.sdk, "clang++").strip()
+        tools = self.ctx.sdk_tools[self.sdk]
+        cc = tools["clang"]
+        cxx = tools["clang++"]
 
         # we put the flags in CC / CXX as sometimes the ./configure test
         # with the preprocessor (aka CC -E) without CFLAGS, which fails for
@@ -183,9 +939,8 @@ class Arch:
         use_ccache = environ.get("USE_CCACHE", "1")
         ccache = None
         if use_ccache == "1":
-            ccache = sh.which('ccache')
+            ccache = self.ctx.ccache
         if ccache:
-            ccache = ccache.strip()
             env["USE_CCACHE"] = "1"
             env["CCACHE"] = ccache
             env.update({k: v for k, v in environ.items() if k.startswith('CCACHE_')})
@@ -195,33 +950,16 @@ class Arch:
                 'CCACHE_SLOPPINESS',
                 ('file_macro,time_macros,'
                  'include_file_mtime,include_file_ctime,file_stat_matches'))
+            logger.info("CC and CXX will use ccache")
+            cc = ccache + " " + cc
+            cxx = ccache + " " + cxx
+        else:
+            logger.info("CC and CXX will not use ccache")
 
-        if not self._ccsh:
-            self._ccsh = tempfile.NamedTemporaryFile()
-            self._cxxsh = tempfile.NamedTemporaryFile()
-            sh.chmod("+x", self._ccsh.name)
-            sh.chmod("+x", self._cxxsh.name)
-            self._ccsh.write(b'#!/bin/sh\n')
-            self._cxxsh.write(b'#!/bin/sh\n')
-            if ccache:
-                logger.info("CC and CXX will use ccache")
-                self._ccsh.write(
-                    (ccache + ' ' + cc + ' "$@"\n').encode("utf8"))
-                self._cxxsh.write(
-                    (ccache + ' ' + cxx + ' "$@"\n').encode("utf8"))
-            else:
-                logger.info("CC and CXX will not use ccache")
-                self._ccsh.write(
-                    (cc + ' "$@"\n').encode("utf8"))
-                self._cxxsh.write(
-                    (cxx + ' "$@"\n').encode("utf8"))
-            self._ccsh.flush()
-            self._cxxsh.flush()
-
-        env["CC"] = self._ccsh.name
-        env["CXX"] = self._cxxsh.name
-        env["AR"] = sh.xcrun("-find", "-sdk", self.sdk, "ar").strip()
-        env["LD"] = sh.xcrun("-find", "-sdk", self.sdk, "ld").strip()
+        env["CC"] = self._write_wrapper("cc", cc)
+        env["CXX"] = self._write_wrapper("cxx", cxx)
+        env["AR"] = tools["ar"]
+        env["LD"] = tools["ld"]
         env["OTHER_CFLAGS"] = " ".join(include_dirs)
         env["OTHER_LDFLAGS"] = " ".join([
             "-L{}/{}".format(self.ctx.dist_dir, "lib"),
@@ -247,7 +985,6 @@ class Arch64Simulator(Arch):
     arch = "x86_64"
     triple = "x86_64-apple-darwin13"
     version_min = "-miphoneos-version-min=9.0"
-    sysroot = sh.xcrun("--sdk", "iphonesimulator", "--show-sdk-path").strip()
 
 
 class Arch64IOS(Arch):
@@ -255,7 +992,6 @@ class Arch64IOS(Arch):
     arch = "arm64"
     triple = "aarch64-apple-darwin13"
     version_min = "-miphoneos-version-min=9.0"
-    sysroot = sh.xcrun("--sdk", "iphoneos", "--show-sdk-path").strip()
 
 
 class Graph:
@@ -279,27 +1015,237 @@ class Graph:
         if dependent in self.graph and dependency in self.graph:
             self.add(dependent, dependency)
 
-    def find_order(self):
+    def get_dependents(self):
+        """Return the reverse graph: each item maps to the items depending
+        on it.
+        """
+        dependents = {name: [] for name in self.graph}
+        for name, deps in self.graph.items():
+            for dep in deps:
+                dependents[dep].append(name)
+        return dependents
+
+    def layers(self):
+        """Topological sort (Kahn's algorithm), in linear time
+
+        :Returns:
+            list of layers, each one the items depending only on items of
+            the previous layers: the items of a layer can be built in
+            parallel.
+        """
+        in_degree = {name: len(deps) for name, deps in self.graph.items()}
+        dependents = self.get_dependents()
+        layer = [name for name, degree in in_degree.items() if not degree]
+        layers = []
+        while layer:
+            layers.append(layer)
+            next_layer = []
+            for name in layer:
+                for dependent in dependents[name]:
+                    in_degree[dependent] -= 1
+                    if not in_degree[dependent]:
+                        next_layer.append(dependent)
+            layer = next_layer
+        if sum(len(layer) for layer in layers) != len(self.graph):
+            cycle = dict((k, v) for k, v in self.graph.items() if in_degree[k])
+            raise ValueError('Dependency cycle detected! %s' % cycle)
+        return layers
+
+    def find_order(self, priority=None):
         """Do a topological sort on a dependency graph
 
         :Parameters:
+            `priority`: dict
+                when several items are ready, the highest priority goes
+                first. Defaults to the critical path of the items, so the
+                longest chains are started first.
             :Returns:
                 iterator, sorted items form first to last
         """
-        graph = dict((k, set(v)) for k, v in self.graph.items())
-        while graph:
-            # Find all items without a parent
-            leftmost = [name for name, dep in graph.items() if not dep]
-            if not leftmost:
-                raise ValueError('Dependency cycle detected! %s' % graph)
-            # If there is more than one, sort them for predictable order
-            leftmost.sort()
-            for result in leftmost:
-                # Yield and remove them from the graph
-                yield result
-                graph.pop(result)
-                for bset in graph.values():
-                    bset.discard(result)
+        import heapq
+        if priority is None:
+            priority = self.critical_path()
+        in_degree = {name: len(deps) for name, deps in self.graph.items()}
+        dependents = self.get_dependents()
+        # ties are broken by the order the items were added in
+        index = {name: i for i, name in enumerate(self.graph)}
+        ready = [(-priority[name], index[name], name)
+                 for name, degree in in_degree.items() if not degree]
+        heapq.heapify(ready)
+        count = 0
+        while ready:
+            name = heapq.heappop(ready)[2]
+            count += 1
+            yield name
+            for dependent in dependents[name]:
+                in_degree[dependent] -= 1
+                if not in_degree[dependent]:
+                    heapq.heappush(ready, (
+                        -priority[dependent], index[dependent], dependent))
+        if count != len(self.graph):
+            cycle = dict((k, v) for k, v in self.graph.items() if in_degree[k])
+            raise ValueError('Dependency cycle detected! %s' % cycle)
+
+    def critical_path(self, weights=None):
+        """Return the length of the critical path starting at each item: the
+        longest chain made of the item and of items depending on it, where
+        each item counts for its `weights` value (1 by default).
+        """
+        dependents = self.get_dependents()
+        lengths = {}
+        for layer in reversed(self.layers()):
+            for name in layer:
+                weight = weights.get(name, 1) if weights else 1
+                lengths[name] = weight + max(
+                    (lengths[dependent] for dependent in dependents[name]),
+                    default=0)
+        return lengths
+
+
+class ForkedJob:
+    """Run `target(*args)` in a forked process.
+
+    Recipes chdir into their build directory and keep per-build attributes on
+    themselves, so two of them can't run in the same process. The child
+    updates `ctx.state` directly, the store supports concurrent processes.
+    """
+    def __init__(self, ctx, name, target, *args):
+        self.ctx = ctx
+        self.name = name
+        self.target = target
+        self.args = args
+        self.process = None
+        self.conn = None
+
+    def start(self):
+        import multiprocessing
+        mp = multiprocessing.get_context("fork")
+        reader, writer = mp.Pipe(duplex=False)
+        self.process = mp.Process(
+            target=self._run, args=(writer, ), name=self.name)
+        self.process.start()
+        writer.close()
+        self.conn = reader
+
+    def _run(self, conn):
+        # the writer thread of the parent isn't running in this process
+        BuildLog.current = None
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(logging.Formatter(
+                '[%(levelname)-8s] [{}] %(message)s'.format(self.name)))
+        success = False
+        try:
+            self.target(*self.args)
+            success = True
+        except (Exception, SystemExit):
+            logger.exception("{} failed".format(self.name))
+        conn.send(success)
+        conn.close()
+
+    def join(self):
+        """Wait for the child and return True if it succeeded
+        """
+        try:
+            success = self.conn.recv()
+        except EOFError:
+            success = False
+        self.conn.close()
+        self.process.join()
+        return success and self.process.exitcode == 0
+
+
+def get_xcode_path():
+    """Return the active developer directory, without running xcode-select
+    when possible.
+    """
+    path = environ.get("DEVELOPER_DIR")
+    if not path:
+        with suppress(OSError):
+            path = readlink("/var/db/xcode_select_link")
+    if not path:
+        path = sh.xcode_select("-print-path").strip()
+    return path
+
+
+class ToolchainProbe:
+    """Results of the commands describing the installed toolchain: SDKs,
+    developer directory, tools location and number of cores.
+
+    They are kept in the user cache, and probed again when the active Xcode,
+    its modification time or the PATH changes, or when a tool disappears or
+    a missing one gets installed.
+    """
+    version = 3
+    tools = ("ccache", "cython-2.7", "cython", "pkg-config", "autoconf",
+             "automake", "libtool", "pigz", "pbzip2")
+    sdks = ("iphonesimulator", "iphoneos")
+    sdk_tools = ("clang", "clang++", "ar", "ld")
+    _loaded = None
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def get_key(self):
+        xcode_path = get_xcode_path()
+        try:
+            mtime = stat(xcode_path).st_mtime
+        except OSError:
+            mtime = None
+        return [self.version, xcode_path, mtime, environ.get("PATH", "")]
+
+    def load(self, reprobe=False):
+        key = self.get_key()
+        cached = ToolchainProbe._loaded
+        if cached is None and exists(self.filename) and not reprobe:
+            with suppress(ValueError, OSError):
+                with open(self.filename) as fd:
+                    cached = json.load(fd)
+        paths = []
+        if cached:
+            paths = list(cached["which"].values())
+            paths += list(cached["sdk_paths"].values())
+            for tools in cached["sdk_tools"].values():
+                paths.extend(tools.values())
+        if cached and not reprobe and cached.get("key") == key and all(
+                exists(path) for path in paths if path) and not any(
+                shutil.which(tool) for tool, path in cached["which"].items()
+                if path is None):
+            ToolchainProbe._loaded = cached
+            return cached
+        logger.debug("Probing the toolchain")
+        probe = self.probe(key)
+        ensure_dir(dirname(self.filename))
+        with open(self.filename + ".tmp", "w") as fd:
+            json.dump(probe, fd)
+        replace(self.filename + ".tmp", self.filename)
+        ToolchainProbe._loaded = probe
+        return probe
+
+    def probe(self, key):
+        probe = {
+            "key": key,
+            "sdks": str(sh.xcodebuild("-showsdks")).splitlines(),
+            "xcode_path": key[1],
+            "which": {},
+            "sdk_tools": {},
+            "sdk_paths": {},
+            "num_cores": None}
+        for tool in self.tools:
+            path = sh.which(tool)
+            probe["which"][tool] = str(path).strip() if path else None
+        for sdk in self.sdks:
+            probe["sdk_paths"][sdk] = None
+            probe["sdk_tools"][sdk] = {
+                tool: None for tool in self.sdk_tools}
+            with suppress(sh.ErrorReturnCode):
+                probe["sdk_paths"][sdk] = sh.xcrun(
+                    "--sdk", sdk, "--show-sdk-path").strip()
+                for tool in self.sdk_tools:
+                    probe["sdk_tools"][sdk][tool] = sh.xcrun(
+                        "-find", "-sdk", sdk, tool).strip()
+        with suppress(Exception):
+            probe["num_cores"] = int(sh.sysctl('-n', 'hw.ncpu'))
+        return probe
 
 
 class Context:
@@ -314,13 +1260,28 @@ class Context:
     sdkver = None
     sdksimver = None
     so_suffix = None  # set by one of the hostpython
+    reprobe = False  # ignore the cached toolchain probe
 
     def __init__(self):
         self.include_dirs = []
+        self.jobs = 1
+        self.parallel_archs = False
+        self.use_binary_cache = True
+        # recipes that must be built from source
+        self.rebuild = set()
+        self.download_connections = 4
 
         ok = True
 
-        sdks = sh.xcodebuild("-showsdks").splitlines()
+        probe = ToolchainProbe(join(user_cache_dir, "probe.json")).load(
+            reprobe=self.reprobe)
+        # probe only once per process
+        Context.reprobe = False
+        which = probe["which"]
+        self.sdk_tools = probe["sdk_tools"]
+        self.sdk_paths = probe["sdk_paths"]
+
+        sdks = probe["sdks"]
 
         # get the latest iphoneos
         iphoneos = [x for x in sdks if "iphoneos" in x]
@@ -342,7 +1303,7 @@ class Context:
 
         # get the path for Developer
         self.devroot = "{}/Platforms/iPhoneOS.platform/Developer".format(
-            sh.xcode_select("-print-path").strip())
+            probe["xcode_path"])
 
         # path to the iOS SDK
         self.iossdkroot = "{}/SDKs/iPhoneOS{}.sdk".format(
@@ -355,37 +1316,42 @@ class Context:
         self.dist_dir = "{}/dist".format(initial_working_directory)
         self.install_dir = "{}/dist/root".format(initial_working_directory)
         self.include_dir = "{}/dist/include".format(initial_working_directory)
+        self.binary_cache = BinaryCache(
+            environ.get("KIVY_IOS_BINARY_CACHE", join(
+                user_cache_dir, "binaries")),
+            self.dist_dir,
+            remote_url=environ.get("KIVY_IOS_REMOTE_CACHE"))
+        self.fingerprints = {}
         self.archs = (
             Arch64Simulator(self),
             Arch64IOS(self))
 
         # path to some tools
-        self.ccache = sh.which("ccache")
+        self.ccache = which["ccache"]
         for cython_fn in ("cython-2.7", "cython"):
-            cython = sh.which(cython_fn)
+            cython = which[cython_fn]
             if cython:
                 self.cython = cython
                 break
         if not self.cython:
             ok = False
-            logger.error("Missing requirement: cython is not installed")
+            logger.error("Missing requirement: cython is not installed "
+                         "(run again with --reprobe once it is)")
 
         # check the basic tools
         for tool in ("pkg-config", "autoconf", "automake", "libtool"):
-            if not sh.which(tool):
-                logger.error("Missing requirement: {} is not installed".format(
-                    tool))
+            if not which[tool]:
+                logger.error("Missing requirement: {} is not installed "
+                             "(run again with --reprobe once it is)".format(
+                                 tool))
 
         if not ok:
             sys.exit(1)
 
-        self.use_pigz = sh.which('pigz')
-        self.use_pbzip2 = sh.which('pbzip2')
+        self.use_pigz = which['pigz']
+        self.use_pbzip2 = which['pbzip2']
 
-        try:
-            num_cores = int(sh.sysctl('-n', 'hw.ncpu'))
-        except Exception:
-            num_cores = None
+        num_cores = probe["num_cores"]
         self.num_cores = num_cores if num_cores else 4  # default to 4 if we can't detect
 
         self.custom_recipes_paths = []
@@ -406,7 +1372,18 @@ class Context:
         self.env.pop("LDFLAGS", None)
 
         # set the state
-        self.state = JsonStore(join(self.dist_dir, "state.db"))
+        self.state = StateStore(join(self.dist_dir, "state.db"))
+
+    def add_include_dir(self, include_dir):
+        """Add an include dir (relative to dist/include, can contain
+        {arch}) to the environment of every arch.
+        """
+        if include_dir in self.include_dirs:
+            return
+        logger.info("Include dir added: {}".format(include_dir))
+        self.include_dirs.append(include_dir)
+        for arch in self.archs:
+            arch.invalidate_env()
 
     @property
     def concurrent_make(self):
@@ -416,8 +1393,18 @@ class Context:
     def concurrent_xcodebuild(self):
         return "IDEBuildOperationMaxNumberOfConcurrentCompileTasks={}".format(self.num_cores)
 
+    @property
+    def concurrent_build_ext(self):
+        # compile the extensions of a setup.py in parallel
+        return "--parallel={}".format(self.num_cores)
+
 
 class Recipe:
+    # (changed, removed) files of dist/ while recording for the binary cache
+    _dist_changes = None
+    # smallest part of a file worth its own connection
+    min_segment_size = 4 * 1024 * 1024
+
     props = {
         "is_alias": False,
         "version": None,
@@ -431,11 +1418,13 @@ class Recipe:
         "include_dir": None,
         "include_per_arch": False,
         "include_name": None,
+        "sha256": None,
         "frameworks": [],
         "sources": [],
         "pbx_frameworks": [],
         "pbx_libraries": [],
-        "hostpython_prerequisites": []
+        "hostpython_prerequisites": [],
+        "relocatable": True
     }
 
     def __new__(cls):
@@ -445,47 +1434,207 @@ class Recipe:
         return super().__new__(cls)
 
     # API available for recipes
-    def download_file(self, url, filename, cwd=None):
+    def download_file(self, url, filename, cwd=None, report_hook=None,
+                      sha256=None, connections=None):
         """
         Download an `url` to `outfn`
+
+        The data goes to `outfn`.part first, and an interrupted download is
+        resumed from there when the server supports it. If `sha256` is
+        given, the file is checked against it.
+
+        Large files are downloaded with up to `connections` (by default
+        `ctx.download_connections`) parallel range requests when the server
+        accepts them. Other schemes than http(s), like ftp, are downloaded
+        with urllib, without resuming.
         """
         if not url:
             return
 
-        def report_hook(index, blksize, size):
+        def _report_hook(received, size):
             if size <= 0:
-                progression = '{0} bytes'.format(index * blksize)
+                progression = '{0} bytes'.format(received)
             else:
                 progression = '{0:.2f}%'.format(
-                        index * blksize * 100. / float(size))
+                        received * 100. / float(size))
             stdout.write('- Download {}\r'.format(progression))
             stdout.flush()
 
+        if report_hook is None:
+            report_hook = _report_hook
+
         if cwd:
             filename = join(cwd, filename)
         with suppress(FileNotFoundError):
             unlink(filename)
-
-        # Clean up temporary files just in case before downloading.
-        urlcleanup()
+        part_fn = "{}.part".format(filename)
 
         logger.info('Downloading {0}'.format(url))
+        if connections is None:
+            connections = self.ctx.download_connections
+        digest = None
+        if urlparse(url).scheme in ("http", "https"):
+            download_part = self._download_part
+            if connections > 1 and not exists(part_fn):
+                if self._download_segmented(
+                        url, part_fn, connections, report_hook):
+                    digest = sha256_file(part_fn)
+        else:
+            download_part = self._download_urllib
         attempts = 0
-        while True:
+        while digest is None:
             try:
-                urlretrieve(url, filename, report_hook)
-            except OSError:
+                digest = download_part(url, part_fn, report_hook)
+            except OSError as e:
+                if is_client_error(e):
+                    raise
                 attempts += 1
                 if attempts >= 5:
                     logger.error('Max download attempts reached: {}'.format(attempts))
                     raise
-                logger.warning('Download failed. Retrying in 1 second...')
+                logger.warning('Download failed. Resuming in 1 second...')
                 time.sleep(1)
-                continue
-            break
 
+        if sha256 and digest != sha256.lower():
+            unlink(part_fn)
+            raise ValueError("Checksum mismatch for {}: expected sha256 {}, "
+                             "got {}".format(url, sha256, digest))
+        replace(part_fn, filename)
         return filename
 
+    def _download_segmented(self, url, part_fn, connections, report_hook):
+        """Download `url` into `part_fn` with `connections` parallel range
+        requests. Return False, without downloading anything, if the server
+        doesn't advertise range support or the file is small.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        session = get_http_session()
+        try:
+            resp = session.head(url, allow_redirects=True, timeout=30)
+            resp.raise_for_status()
+        except OSError:
+            return False
+        size = int(resp.headers.get("Content-Length", 0))
+        connections = min(connections, size // self.min_segment_size)
+        if resp.headers.get("Accept-Ranges") != "bytes" or connections < 2:
+            return False
+        # the final url, to not follow the redirections for every segment
+        url = resp.url
+
+        seg_fn = "{}.segments".format(part_fn)
+        with open(seg_fn, "wb") as fd:
+            fd.truncate(size)
+        step = -(-size // connections)
+        ranges = [(start, min(start + step, size) - 1)
+                  for start in range(0, size, step)]
+        received = [0] * len(ranges)
+        lock = threading.Lock()
+
+        def fetch_segment(index):
+            start, end = ranges[index]
+            attempts = 0
+            while start + received[index] <= end:
+                offset = start + received[index]
+                headers = {"Range": "bytes={}-{}".format(offset, end)}
+                try:
+                    with session.get(url, headers=headers, stream=True,
+                                     timeout=60) as resp:
+                        resp.raise_for_status()
+                        if resp.status_code != 206:
+                            raise ValueError("Range request not honoured")
+                        with open(seg_fn, "r+b") as fd:
+                            fd.seek(offset)
+                            for chunk in iter_raw_content(resp):
+                                chunk = chunk[:end + 1 - offset]
+                                fd.write(chunk)
+                                offset += len(chunk)
+                                with lock:
+                                    received[index] += len(chunk)
+                                    report_hook(sum(received), size)
+                except OSError as e:
+                    attempts += 1
+                    if attempts >= 5 or is_client_error(e):
+                        raise
+                    logger.warning('Segment download failed. Resuming in 1 second...')
+                    time.sleep(1)
+
+        logger.info("Downloading in {} segments".format(len(ranges)))
+        try:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                list(executor.map(fetch_segment, range(len(ranges))))
+        except ValueError:
+            logger.info("Server doesn't support segmented downloads")
+            unlink(seg_fn)
+            return False
+        except BaseException:
+            unlink(seg_fn)
+            raise
+        replace(seg_fn, part_fn)
+        return True
+
+    def _download_part(self, url, part_fn, report_hook):
+        """Download `url` into `part_fn`, continuing from its current content
+        if the server accepts range requests. Return the sha256 of the
+        whole file.
+        """
+        h = hashlib.sha256()
+        received = 0
+        with suppress(FileNotFoundError):
+            with open(part_fn, "rb") as fd:
+                for chunk in iter(lambda: fd.read(1 << 20), b""):
+                    h.update(chunk)
+                    received += len(chunk)
+        headers = {}
+        if received:
+            headers["Range"] = "bytes={}-".format(received)
+        with get_http_session().get(
+                url, headers=headers, stream=True, timeout=60) as resp:
+            if received and resp.status_code == 416:
+                # nothing after what we have, check it is the whole file
+                total = resp.headers.get("Content-Range", "").split("/")[-1]
+                if total == str(received):
+                    return h.hexdigest()
+                unlink(part_fn)
+                raise IOError("Invalid partial download {}".format(part_fn))
+            resp.raise_for_status()
+            if received and resp.status_code != 206:
+                logger.info("Server doesn't support resuming, restarting")
+                h = hashlib.sha256()
+                received = 0
+            size = int(resp.headers.get("Content-Length", -1))
+            if size >= 0:
+                size += received
+            with open(part_fn, "ab" if received else "wb") as fd:
+                for chunk in iter_raw_content(resp):
+                    fd.write(chunk)
+                    h.update(chunk)
+                    received += len(chunk)
+                    report_hook(received, size)
+        if size >= 0 and received < size:
+            raise IOError("Download of {} interrupted at {} of {} bytes".format(
+                url, received, size))
+        return h.hexdigest()
+
+    def _download_urllib(self, url, part_fn, report_hook):
+        """Download `url` into `part_fn` with urllib, for the schemes
+        requests doesn't handle. Return the sha256 of the file.
+        """
+        from urllib.request import Request, urlopen
+        h = hashlib.sha256()
+        received = 0
+        request = Request(url, headers={"User-Agent": download_user_agent})
+        with urlopen(request, timeout=60) as resp, open(part_fn, "wb") as fd:
+            size = int(resp.headers.get("Content-Length") or -1)
+            for chunk in iter(lambda: resp.read(1 << 16), b""):
+                fd.write(chunk)
+                h.update(chunk)
+                received += len(chunk)
+                report_hook(received, size)
+        if size >= 0 and received < size:
+            raise IOError("Download of {} interrupted at {} of {} bytes".format(
+                url, received, size))
+        return h.hexdigest()
+
     def extract_file(self, filename, cwd):
         """
         Extract the `filename` into the directory `cwd`.
@@ -494,48 +1643,81 @@ class Recipe:
             return
         logger.info("Extract {} into {}".format(filename, cwd))
         if filename.endswith((".tgz", ".tar.gz")):
-            if self.ctx.use_pigz:
-                comp = '--use-compress-program={}'.format(self.ctx.use_pigz)
-            else:
-                comp = '-z'
-            shprint(sh.tar, "-C", cwd, "-xv", comp, "-f", filename)
-
+            decompressor = self.ctx.use_pigz
         elif filename.endswith((".tbz2", ".tar.bz2")):
-            if self.ctx.use_pbzip2:
-                comp = '--use-compress-program={}'.format(self.ctx.use_pbzip2)
-            else:
-                comp = '-j'
-            shprint(sh.tar, "-C", cwd, "-xv", comp, "-f", filename)
-
+            decompressor = self.ctx.use_pbzip2
         elif filename.endswith(".zip"):
-            shprint(sh.unzip, "-d", cwd, filename)
-
+            decompressor = None
         else:
             logger.error("Cannot extract, unrecognized extension for {}".format(
                 filename))
             raise Exception()
-
-    def get_archive_rootdir(self, filename):
+        start = time.time()
+        extractor = ArchiveExtractor(cwd, workers=self.ctx.num_cores)
+        extractor.extract(filename, decompressor=decompressor)
+        logger.info("Extracted {} files ({:.1f} MB) in {:.1f}s".format(
+            extractor.count, extractor.size / 1024. / 1024.,
+            time.time() - start))
+
+    def get_archive_index(self, filename):
+        """
+        Return the index of the archive `filename`: its root directory,
+        number of members, uncompressed size and sha256. The index is
+        stored next to the archive, so it is only computed once.
+        """
+        import tarfile
+        import zipfile
+        index_fn = "{}.index.json".format(filename)
+        st = stat(filename)
+        with suppress(OSError, ValueError, KeyError):
+            with open(index_fn) as fd:
+                index = json.load(fd)
+            if (index["mtime"], index["archive_size"]) == (
+                    st.st_mtime, st.st_size):
+                return index
+        index = {
+            "mtime": st.st_mtime,
+            "archive_size": st.st_size,
+            "root": None,
+            "members": 0,
+            "size": 0}
         if filename.endswith((".tgz", ".tar.gz", ".tbz2", ".tar.bz2")):
-            try:
-                archive = tarfile.open(filename)
-            except tarfile.ReadError:
-                logger.warning('Error extracting the archive {0}'.format(filename))
-                logger.warning(
-                    'This is usually caused by a corrupt download. The file'
-                    ' will be removed and re-downloaded on the next run.')
-                logger.warning(filename)
-                return
-
-            root = archive.next().path.split("/")
-            return root[0]
+            with tarfile.open(filename, "r|*") as archive:
+                for member in archive:
+                    if index["root"] is None:
+                        index["root"] = member.path.split("/")[0]
+                    index["members"] += 1
+                    index["size"] += member.size
         elif filename.endswith(".zip"):
             with zipfile.ZipFile(filename) as zf:
-                return dirname(zf.namelist()[0])
+                infos = zf.infolist()
+                index["root"] = dirname(infos[0].filename)
+                index["members"] = len(infos)
+                index["size"] = sum(info.file_size for info in infos)
         else:
+            raise ValueError("Unrecognized extension for {}".format(filename))
+        index["sha256"] = sha256_file(filename)
+        with open(index_fn + ".tmp", "w") as fd:
+            json.dump(index, fd)
+        replace(index_fn + ".tmp", index_fn)
+        return index
+
+    def get_archive_rootdir(self, filename):
+        import tarfile
+        if not filename.endswith((
+                ".tgz", ".tar.gz", ".tbz2", ".tar.bz2", ".zip")):
             logger.error("Unrecognized extension for {}."
                          " Cannot detect root directory".format(filename))
             raise Exception()
+        try:
+            return self.get_archive_index(filename)["root"]
+        except (tarfile.TarError, EOFError, OSError):
+            logger.warning('Error extracting the archive {0}'.format(filename))
+            logger.warning(
+                'This is usually caused by a corrupt download. The file'
+                ' will be removed and re-downloaded on the next run.')
+            logger.warning(filename)
+            return
 
     def apply_patch(self, filename, target_dir=''):
         """
@@ -632,6 +1814,126 @@ class Recipe:
     def get_build_dir(self, arch):
         return join(self.ctx.build_dir, self.name, arch, self.archive_root)
 
+    def get_step_fingerprint(self, step):
+        """Return the fingerprint recorded in the state when `step` runs, the
+        step is run again when it changes.
+        """
+        if step == "download":
+            # only the archive matters
+            h = hashlib.sha256()
+            for value in (self.version, self.url, self.sha256):
+                h.update("{}\0".format(value).encode("utf-8"))
+            return h.hexdigest()
+        return self.get_fingerprint()
+
+    def is_legacy_step_valid(self, step):
+        """Tell if the result of `step`, recorded as True by a toolchain
+        without fingerprints, can be kept. Their inputs are unknown, they are
+        kept as they would have been, except a download whose archive is
+        missing, broken or doesn't match the recipe sha256.
+        """
+        if step != "download" or not self.url or self.custom_dir:
+            return True
+        if exists(join(self.recipe_dir, self.url)):
+            return True
+        import tarfile
+        import zipfile
+        try:
+            index = self.get_archive_index(self.archive_fn)
+        except (OSError, ValueError, EOFError, tarfile.TarError,
+                zipfile.BadZipFile):
+            return False
+        return not self.sha256 or index["sha256"] == self.sha256.lower()
+
+    def invalidate_step(self, step, *args):
+        """Remove what an outdated run of `step` left behind before it runs
+        again.
+        """
+        if step == "download":
+            if exists(self.archive_fn):
+                unlink(self.archive_fn)
+        elif step == "extract":
+            shutil.rmtree(join(self.ctx.build_dir, self.name),
+                          ignore_errors=True)
+        elif step == "build":
+            arch = args[0].arch
+            shutil.rmtree(join(self.ctx.build_dir, self.name, arch),
+                          ignore_errors=True)
+            self.extract_arch(arch)
+
+    def get_fingerprint(self):
+        """Return a hash of what the result of the recipe depends on.
+
+        The path of dist/ is only part of it for the recipes that are not
+        `relocatable` (they have their prefix compiled in) and the ones
+        installing pip packages, whose scripts have an absolute shebang.
+        """
+        fingerprint = self.get_content_fingerprint()
+        if (self.relocatable and not self.hostpython_prerequisites
+                and not self.python_depends):
+            return fingerprint
+        h = hashlib.sha256()
+        for value in (fingerprint, self.ctx.dist_dir):
+            h.update("{}\0".format(value).encode("utf-8"))
+        return h.hexdigest()
+
+    def get_content_fingerprint(self):
+        """Return a hash of the recipe version, files and patches, the
+        fingerprints of its dependencies, the SDK and the compiler flags.
+        """
+        fingerprints = self.ctx.fingerprints
+        if self.name in fingerprints:
+            return fingerprints[self.name]
+        h = hashlib.sha256()
+
+        def add(value):
+            h.update(str(value).encode("utf-8"))
+            h.update(b"\0")
+
+        add(self.name)
+        add(self.version)
+        add(self.url)
+        for root, dirnames, filenames in walk(self.recipe_dir):
+            dirnames[:] = sorted(d for d in dirnames if d != "__pycache__")
+            for fn in sorted(filenames):
+                if fn.endswith(".pyc"):
+                    continue
+                path = join(root, fn)
+                add(relpath(path, self.recipe_dir))
+                with open(path, "rb") as fd:
+                    add(hashlib.sha256(fd.read()).hexdigest())
+        for depend, fingerprint in self.get_depends_fingerprints():
+            add(depend)
+            add(fingerprint)
+        add(self.ctx.sdkver)
+        add(self.ctx.sdksimver)
+        for arch in self.filtered_archs:
+            env = arch.get_env()
+            add(arch.arch)
+            for key in ("CFLAGS", "LDFLAGS", "OTHER_CFLAGS", "OTHER_LDFLAGS"):
+                # search paths depend on the set of recipes being built, the
+                # dependencies are already part of the fingerprint
+                flags = [flag for flag in env[key].split()
+                         if not flag.startswith(("-I", "-L"))]
+                add(" ".join(flags))
+        fingerprints[self.name] = h.hexdigest()
+        return fingerprints[self.name]
+
+    def get_depends_fingerprints(self):
+        """Return the (name, content fingerprint) of the dependencies and
+        the optional dependencies built, sorted by name.
+        """
+        depends = set(self.depends)
+        depends.update(
+            depend for depend in self.optional_depends
+            if "{}.build_all".format(depend) in self.ctx.state)
+        fingerprints = []
+        for depend in sorted(depends):
+            recipe = Recipe.get_recipe(depend, self.ctx)
+            recipe.ctx = self.ctx
+            fingerprints.append((depend, recipe.get_content_fingerprint()))
+        return fingerprints
+
     # Public Recipe API to be subclassed if needed
 
     def init_with_ctx(self, ctx):
@@ -644,8 +1946,7 @@ class Recipe:
             else:
                 include_dir = join("common", include_name)
         if include_dir:
-            logger.info("Include dir added: {}".format(include_dir))
-            self.ctx.include_dirs.append(include_dir)
+            self.ctx.add_include_dir(include_dir)
 
     def get_recipe_env(self, arch=None):
         """Return the env specialized for the recipe
@@ -697,10 +1998,95 @@ class Recipe:
     def execute(self):
         if self.custom_dir:
             self.ctx.state.remove_all(self.name)
-        self.download()
-        self.extract()
-        self.install_hostpython_prerequisites()
-        self.build_all()
+        BuildTrace.recipe = self.name
+        with BuildTrace.span(self.name, "recipe", recipe=self.name) as args:
+            if self.restore_binary_cache():
+                args["cached"] = True
+                return
+            logger.info("Build {}".format(self.name))
+            with BuildLog.open(self.ctx, self.name):
+                self.download()
+                self.extract()
+                with self.dist_writer():
+                    self.install_hostpython_prerequisites()
+                self.build_all()
+            self.store_binary_cache()
+
+    def restore_binary_cache(self):
+        """Restore the result of a previous build with the same
+        fingerprint. Return True if the recipe doesn't need to be built.
+        """
+        self._dist_changes = None
+        state = self.ctx.state
+        prefix = "{}.".format(self.name)
+        fingerprint = self.get_fingerprint()
+        if (not self.ctx.use_binary_cache or self.custom_dir
+                or not self.binary_cacheable
+                or self.name in self.ctx.rebuild
+                or state.get("{}.build_all".format(self.name)) == fingerprint):
+            return False
+        with self.dist_writer():
+            keys = self.ctx.binary_cache.restore(self.name, fingerprint)
+        if keys is None:
+            # record what the build does to dist/, unless a previous attempt
+            # already ran some of the install steps
+            steps = (prefix + "install", prefix + "make_lipo")
+            if not any(key.startswith(steps) for key in state.keys()):
+                self._dist_changes = (set(), set())
+            return False
+        with state.transaction():
+            for key, value in keys.items():
+                if not key.startswith(prefix):
+                    # an entry can only describe its own recipe
+                    logger.warning("Ignoring the state key {} of the {} "
+                                   "cache entry".format(key, self.name))
+                elif key.endswith(".archive_root"):
+                    state[key] = value
+                else:
+                    self.update_state(key, fingerprint)
+        return True
+
+    @property
+    def binary_cacheable(self):
+        """Only the changes of the steps run under dist_writer() are
+        recorded: a recipe overriding build_all may write into dist/ outside
+        of them, and is always built.
+        """
+        return type(self).build_all is Recipe.build_all
+
+    def store_binary_cache(self):
+        if self._dist_changes is None:
+            return
+        changed, removed = self._dist_changes
+        self._dist_changes = None
+        prefix = "{}.".format(self.name)
+        state = self.ctx.state
+        # the build directories are not part of the cache
+        skipped = tuple(prefix + step for step in ("download", "extract", "build."))
+        keys = {
+            key: state[key] for key in state.keys()
+            if key.startswith(prefix) and not key.startswith(skipped)
+            and not key.endswith(".at")}
+        self.ctx.binary_cache.store(
+            self.name, self.get_fingerprint(), changed, removed, keys)
+
+    @contextmanager
+    def dist_writer(self):
+        """Serialize the steps writing into dist/ between parallel builds,
+        and record what they change for the binary cache.
+        """
+        with file_lock(join(self.ctx.dist_dir, ".lock")):
+            recording = self._dist_changes is not None
+            if recording:
+                before = self.ctx.binary_cache.snapshot()
+            yield
+            if recording:
+                changed, removed = diff_snapshot(
+                    before, self.ctx.binary_cache.snapshot())
+                all_changed, all_removed = self._dist_changes
+                self._dist_changes = (
+                    (all_changed - removed) | changed,
+                    (all_removed - changed) | removed)
 
     @property
     def custom_dir(self):
@@ -733,7 +2119,9 @@ class Recipe:
                 return
             fn = self.archive_fn
             if not exists(fn):
-                self.download_file(self.url.format(version=self.version), fn)
+                self.download_file(
+                    self.url.format(version=self.version), fn,
+                    sha256=self.sha256)
             status = self.get_archive_rootdir(self.archive_fn)
             if status is not None:
                 self.ctx.state[key] = status
@@ -745,6 +2133,25 @@ class Recipe:
             logger.info("Extract {} for {}".format(self.name, arch.arch))
             self.extract_arch(arch.arch)
 
+    @property
+    def pristine_dir(self):
+        """Directory where the archive is extracted once, shared by all the
+        archs (and by all the recipes using the same archive).
+        """
+        index = self.get_archive_index(self.archive_fn)
+        return join(self.ctx.cache_dir, "sources", index["sha256"])
+
+    def extract_pristine(self):
+        pristine_dir = self.pristine_dir
+        ensure_dir(dirname(pristine_dir))
+        with file_lock(pristine_dir + ".lock"):
+            if not exists(pristine_dir):
+                tmp_dir = pristine_dir + ".tmp"
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                self.extract_file(self.archive_fn, tmp_dir)
+                replace(tmp_dir, pristine_dir)
+        return pristine_dir
+
     def extract_arch(self, arch):
         build_dir = join(self.ctx.build_dir, self.name, arch)
         dest_dir = join(build_dir, self.archive_root)
@@ -759,7 +2166,10 @@ class Recipe:
                 shutil.copytree(src_dir, dest_dir)
                 return
             ensure_dir(build_dir)
-            self.extract_file(self.archive_fn, build_dir)
+            pristine_dir = self.extract_pristine()
+            for fn in listdir(pristine_dir):
+                if not exists(join(build_dir, fn)):
+                    clone_tree(join(pristine_dir, fn), join(build_dir, fn))
 
     @cache_execution
     def install_hostpython_prerequisites(self):
@@ -782,13 +2192,16 @@ class Recipe:
 
         self.set_marker("building")
 
+        log_progress("Build {} for {}".format(self.name, arch.arch))
         chdir(self.build_dir)
-        logger.info("Prebuild {} for {}".format(self.name, arch.arch))
-        self.prebuild_arch(arch)
-        logger.info("Build {} for {}".format(self.name, arch.arch))
-        self.build_arch(arch)
-        logger.info("Postbuild {} for {}".format(self.name, arch.arch))
-        self.postbuild_arch(arch)
+        with BuildLog.open(self.ctx, "{}-{}".format(self.name, arch.arch)):
+            for step in ("prebuild", "build", "postbuild"):
+                logger.info("{} {} for {}".format(
+                    step.capitalize(), self.name, arch.arch))
+                with BuildTrace.span(
+                        "{}.{}_arch.{}".format(self.name, step, arch.arch),
+                        "step", recipe=self.name, arch=arch.arch):
+                    getattr(self, "{}_arch".format(step))(arch)
         self.delete_marker("building")
         self.set_marker("build_done")
 
@@ -798,8 +2211,21 @@ class Recipe:
         logger.info("Build {} for {} (filtered)".format(
             self.name,
             ", ".join([x.arch for x in filtered_archs])))
-        for arch in self.filtered_archs:
-            self.build(arch)
+        if self.ctx.parallel_archs and len(filtered_archs) > 1:
+            self.build_archs_parallel(filtered_archs)
+        else:
+            for arch in filtered_archs:
+                self.build(arch)
+
+        with self.dist_writer():
+            self.install_all()
+
+    def install_all(self):
+        """Lipo the libraries and install the recipe into dist/
+        """
+        def step(name):
+            return BuildTrace.span(
+                "{}.{}".format(self.name, name), "step", recipe=self.name)
 
         name = self.name
         if self.library:
@@ -809,24 +2235,51 @@ class Recipe:
             static_fn = join(self.ctx.dist_dir, "lib", "{}.a".format(name))
             ensure_dir(dirname(static_fn))
             logger.info("Lipo {} to {}".format(self.name, static_fn))
-            self.make_lipo(static_fn)
+            with step("make_lipo"):
+                self.make_lipo(static_fn)
         if self.libraries:
             logger.info("Create multiple lipo for {}".format(name))
             for library in self.libraries:
                 static_fn = join(self.ctx.dist_dir, "lib", basename(library))
                 ensure_dir(dirname(static_fn))
                 logger.info("  - Lipo-ize {}".format(library))
-                self.make_lipo(static_fn, library)
+                with step("make_lipo"):
+                    self.make_lipo(static_fn, library)
         logger.info("Install include files for {}".format(self.name))
-        self.install_include()
+        with step("install_include"):
+            self.install_include()
         logger.info("Install frameworks for {}".format(self.name))
-        self.install_frameworks()
+        with step("install_frameworks"):
+            self.install_frameworks()
         logger.info("Install sources for {}".format(self.name))
-        self.install_sources()
+        with step("install_sources"):
+            self.install_sources()
         logger.info("Install python deps for {}".format(self.name))
-        self.install_python_deps()
+        with step("install_python_deps"):
+            self.install_python_deps()
         logger.info("Install {}".format(self.name))
-        self.install()
+        with step("install"):
+            self.install()
+
+    def build_archs_parallel(self, archs):
+        """Build all the `archs` at the same time, each one in its own
+        process, and wait for all of them before going on with lipo and
+        install.
+        """
+        jobs = []
+        for arch in archs:
+            name = "{}/{}".format(self.name, arch.arch)
+            logger.info("Start build of {}".format(name))
+            job = ForkedJob(self.ctx, name, self.build, arch)
+            job.start()
+            jobs.append(job)
+        failed = [job.name for job in jobs if not job.join()]
+        if failed:
+            raise Exception("Build failed for {}".format(", ".join(failed)))
+        # leave the same build dir and cwd as the serial build would
+        self.build_dir = self.get_build_dir(archs[-1].arch)
+        if isdir(self.build_dir):
+            chdir(self.build_dir)
 
     def prebuild_arch(self, arch):
         prebuild = "prebuild_{}".format(arch.arch)
@@ -854,9 +2307,10 @@ class Recipe:
         but it needs to be done manually in recipes.
         """
         key_time = "{}.at".format(key)
-        self.ctx.state[key] = value
         now_str = str(datetime.utcnow())
-        self.ctx.state[key_time] = now_str
+        with self.ctx.state.transaction():
+            self.ctx.state[key] = value
+            self.ctx.state[key_time] = now_str
         logger.debug("New State: {} at {}".format(key, now_str))
 
     @cache_execution
@@ -1024,6 +2478,8 @@ class PythonRecipe(Recipe):
         shprint(
             hostpython,
             "setup.py",
+            "build_ext",
+            self.ctx.concurrent_build_ext,
             "install",
             "-O2",
             "--root", self.ctx.python_prefix,
@@ -1042,23 +2498,139 @@ class CythonRecipe(PythonRecipe):
     pre_build_ext = False
     cythonize = True
 
-    def cythonize_file(self, filename):
-        if filename.startswith(self.build_dir):
-            filename = filename[len(self.build_dir) + 1:]
-        logger.info("Cythonize {}".format(filename))
+    def cythonize_file(self, *filenames):
+        filenames = [
+            filename[len(self.build_dir) + 1:]
+            if filename.startswith(self.build_dir) else filename
+            for filename in filenames]
+        logger.info("Cythonize {}".format(" ".join(filenames)))
         # note when kivy-ios package installed the `cythonize.py` script
         # doesn't (yet) have the executable bit hence we explicitly call it
-        # with the Python interpreter
+        # with the Python interpreter. This one has Cython installed (see
+        # requirements.txt), the script then compiles all the files in-process
         cythonize_script = join(self.ctx.root_dir, "tools", "cythonize.py")
-        shprint(sh.python, cythonize_script, filename)
+        shprint(sh.Command(sys.executable), cythonize_script, *filenames)
 
     def cythonize_build(self):
         if not self.cythonize:
             return
         root_dir = self.build_dir
-        for root, dirnames, filenames in walk(root_dir):
-            for filename in fnmatch.filter(filenames, "*.pyx"):
-                self.cythonize_file(join(root, filename))
+        filenames = []
+        includes = []
+        for root, dirnames, fns in walk(root_dir):
+            for filename in sorted(fns):
+                if filename.endswith(".pyx"):
+                    filenames.append(join(root, filename))
+                elif filename.endswith((".pxd", ".pxi")):
+                    includes.append(join(root, filename))
+        self.cythonize_files(filenames, includes)
+
+    def get_cython_version(self):
+        """Version of the Cython used by cythonize.py: the module of this
+        interpreter when it is installed, else the cython executable.
+        """
+        if getattr(self.ctx, "cython_version", None) is None:
+            try:
+                import Cython
+                self.ctx.cython_version = Cython.__version__
+            except ImportError:
+                cython = sh.Command(self.ctx.cython)
+                self.ctx.cython_version = str(
+                    cython("--version", _err_to_out=True)).strip()
+        return self.ctx.cython_version
+
+    def get_cythonize_hashes(self, filenames, includes):
+        """Return the hash of the inputs of each .pyx: its path and content,
+        the Cython version, the cythonize script, all the .pxd/.pxi of the
+        tree (any of them can be cimported or included) and the
+        fingerprints of the dependencies, whose installed .pxd can be
+        cimported too. It doesn't depend on the arch, the C files are the
+        same for all of them.
+        """
+        h = hashlib.sha256()
+        h.update(self.get_cython_version().encode("utf-8"))
+        h.update(sha256_file(join(
+            self.ctx.root_dir, "tools", "cythonize.py")).encode("utf-8"))
+        for depend, fingerprint in self.get_depends_fingerprints():
+            h.update("{}\0{}\0".format(depend, fingerprint).encode("utf-8"))
+        for filename in includes:
+            h.update(relpath(filename, self.build_dir).encode("utf-8"))
+            h.update(sha256_file(filename).encode("utf-8"))
+        common = h.hexdigest()
+        return {
+            filename: hashlib.sha256("{}{}{}".format(
+                common, relpath(filename, self.build_dir),
+                sha256_file(filename)).encode("utf-8")).hexdigest()
+            for filename in filenames}
+
+    def cythonize_files(self, filenames, includes=()):
+        """Cythonize the .pyx `filenames` whose inputs changed since the
+        last run, with one cythonize.py process per core.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        hashes_fn = join(self.build_dir, ".cythonize.json")
+        previous = {}
+        with suppress(OSError, ValueError):
+            with open(hashes_fn) as fd:
+                previous = json.load(fd)
+        hashes = self.get_cythonize_hashes(filenames, list(includes))
+        todo = [
+            filename for filename in filenames
+            if previous.get(filename) != hashes[filename]
+            or not exists(filename[:-3] + "c")]
+        # the C files generated for another arch or a previous build
+        cached = [filename for filename in todo
+                  if self.restore_cythonized(filename, hashes[filename])]
+        todo = [filename for filename in todo if filename not in cached]
+        logger.info("Cythonize {} files ({} unchanged, {} from the cache)".format(
+            len(todo), len(filenames) - len(todo) - len(cached), len(cached)))
+        if todo:
+            # largest first, spread over the processes
+            todo.sort(key=lambda filename: -stat(filename).st_size)
+            jobs = max(1, min(self.ctx.num_cores, len(todo)))
+            chunks = [todo[i::jobs] for i in range(jobs)]
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                for future in [executor.submit(self.cythonize_file, *chunk)
+                               for chunk in chunks]:
+                    future.result()
+        # cython removes the .c of the files it failed to compile
+        done = [filename for filename in todo if exists(filename[:-3] + "c")]
+        for filename in done:
+            self.store_cythonized(filename, hashes[filename])
+        previous.update(
+            (filename, hashes[filename]) for filename in done + cached)
+        with open(hashes_fn, "w") as fd:
+            json.dump(previous, fd)
+
+    # files generated by cython, next to the .pyx
+    cythonized_exts = (".c", ".h", "_api.h")
+
+    def get_cythonized_cache(self, key):
+        return join(self.ctx.cache_dir, "cythonized", key[:2], key)
+
+    def restore_cythonized(self, filename, key):
+        """Copy the files generated from the .pyx `filename` from the cache
+        of cythonized files. Return False if they aren't there.
+        """
+        cached = self.get_cythonized_cache(key)
+        if not exists(cached + ".c"):
+            return False
+        base = filename[:-4]
+        for ext in self.cythonized_exts:
+            if exists(cached + ext):
+                shutil.copyfile(cached + ext, base + ext)
+        return True
+
+    def store_cythonized(self, filename, key):
+        cached = self.get_cythonized_cache(key)
+        ensure_dir(dirname(cached))
+        base = filename[:-4]
+        # the .c goes last, it marks a complete entry
+        for ext in reversed(self.cythonized_exts):
+            if exists(base + ext):
+                tmp_fn = "{}{}.{}".format(cached, ext, getpid())
+                shutil.copyfile(base + ext, tmp_fn)
+                replace(tmp_fn, cached + ext)
 
     def biglink(self):
         dirs = []
@@ -1082,26 +2654,40 @@ class CythonRecipe(PythonRecipe):
         build_env = self.get_recipe_env(arch)
         hostpython = sh.Command(self.ctx.hostpython)
         if self.pre_build_ext:
-            with suppress(Exception):
-                shprint(hostpython, "setup.py", "build_ext", "-g",
-                        _env=build_env)
+            # generate what cythonization needs, without compiling
+            configure_script = join(
+                self.ctx.root_dir, "tools", "configure_build_ext.py")
+            try:
+                shprint(hostpython, configure_script, "-g", _env=build_env)
+            except sh.ErrorReturnCode:
+                # a full build_ext generates the same files before failing
+                # on the extensions that are not cythonized yet
+                logger.warning("Configure of {} failed, running build_ext "
+                               "instead".format(self.name))
+                with suppress(Exception):
+                    shprint(hostpython, "setup.py", "build_ext", "-g",
+                            _env=build_env)
         self.cythonize_build()
         shprint(hostpython, "setup.py", "build_ext", "-g",
-                _env=build_env)
+                self.ctx.concurrent_build_ext, _env=build_env)
         self.biglink()
 
 
-def build_recipes(names, ctx):
-    # gather all the dependencies
-    logger.info("Want to build {}".format(names))
+def get_recipes_graph(names, ctx):
+    """Load the `names` recipes and all their dependencies, and return
+    their dependency graph.
+    """
     graph = Graph()
-    ctx.wanted_recipes = names[:]
-    recipe_to_load = names
-    recipe_loaded = []
-    while names:
-        name = recipe_to_load.pop(0)
-        if name in recipe_loaded:
-            continue
+    recipe_to_load = deque(names)
+    queued = set(names)
+
+    def add_to_queue(name):
+        if name not in queued:
+            queued.add(name)
+            recipe_to_load.append(name)
+
+    while recipe_to_load:
+        name = recipe_to_load.popleft()
         try:
             recipe = Recipe.get_recipe(name, ctx)
         except KeyError:
@@ -1112,34 +2698,301 @@ def build_recipes(names, ctx):
             name, recipe.depends, recipe.optional_depends))
         for depend in recipe.depends:
             graph.add(name, depend)
-            recipe_to_load += recipe.depends
+            add_to_queue(depend)
         for depend in recipe.optional_depends:
             # in case of compilation after the initial one, take in account
             # of the already compiled recipes
             key = "{}.build_all".format(depend)
             if key in ctx.state:
-                recipe_to_load.append(name)
+                add_to_queue(depend)
                 graph.add(name, depend)
             else:
                 graph.add_optional(name, depend)
-        recipe_loaded.append(name)
+    return graph
+
+
+def get_reverse_depends(ctx):
+    """Return the recipes depending directly on each recipe, through their
+    depends or optional_depends, for all the known recipes.
+    """
+    names = list(Recipe.list_recipes())
+    names += [basename(path) for path in ctx.custom_recipes_paths]
+    reverse_depends = {}
+    # the aliases (python, hostpython) are modules, the state tells which
+    # recipe they resolved to
+    for fn in listdir(join(ctx.root_dir, "recipes")):
+        alias = fn[:-3]
+        if fn.endswith(".py") and ctx.state.get(alias):
+            reverse_depends.setdefault(ctx.state[alias], set()).add(alias)
+    for name in names:
+        # a recipe that fails to import can't be built either
+        with suppress(Exception):
+            recipe = Recipe.get_recipe(name, ctx)
+            for depend in recipe.depends + recipe.optional_depends:
+                depend = depend.split("==")[0]
+                reverse_depends.setdefault(depend, set()).add(name)
+    return reverse_depends
+
+
+def get_dependents(names, ctx):
+    """Return the recipes depending, directly or not, on the `names` recipes.
+    """
+    reverse_depends = get_reverse_depends(ctx)
+    dependents = set()
+    to_visit = list(names)
+    while to_visit:
+        for dependent in reverse_depends.get(to_visit.pop(), ()):
+            if dependent not in dependents and dependent not in names:
+                dependents.add(dependent)
+                to_visit.append(dependent)
+    return dependents
+
+
+def prune_sources(ctx):
+    """Remove the pristine source trees of .cache/sources that no archive
+    of the current recipes extracts to, like the ones of previous versions.
+    """
+    sources_dir = join(ctx.cache_dir, "sources")
+    if not isdir(sources_dir):
+        return
+    names = list(Recipe.list_recipes())
+    names += [basename(path) for path in ctx.custom_recipes_paths]
+    used = set()
+    for name in names:
+        with suppress(Exception):
+            recipe = Recipe.get_recipe(name, ctx)
+            recipe.ctx = ctx
+            if recipe.url and exists(recipe.archive_fn):
+                used.add(basename(recipe.pristine_dir))
+    keys = {fn.split(".")[0] for fn in listdir(sources_dir)}
+    for key in sorted(keys - used):
+        logger.info("Remove the unused source tree {}".format(key))
+        lock_fn = join(sources_dir, key + ".lock")
+        with file_lock(lock_fn):
+            for fn in (key, key + ".tmp"):
+                shutil.rmtree(join(sources_dir, fn), ignore_errors=True)
+        with suppress(FileNotFoundError):
+            unlink(lock_fn)
+
+
+def clean_recipes(names, ctx):
+    """Remove the build directory and state of the `names` recipes and of
+    all the recipes depending on them, so they are built again. Return the
+    recipes cleaned.
+    """
+    names = [name.split("==")[0] for name in names]
+    cleaned = names + sorted(get_dependents(names, ctx))
+    for name in cleaned:
+        logger.info("Cleaning {} build".format(name))
+        ctx.state.remove_all("{}.".format(name))
+        shutil.rmtree(join(ctx.build_dir, name), ignore_errors=True)
+    return cleaned
+
+
+def estimate_build_time(graph, weights, jobs):
+    """Return the expected duration of a build of `graph` with `jobs`
+    recipes at the same time, knowing the duration of each one.
+    """
+    critical = max(graph.critical_path(weights).values(), default=0)
+    return max(critical, sum(weights.values()) / jobs)
+
 
-    build_order = list(graph.find_order())
+def build_recipes(names, ctx):
+    # gather all the dependencies
+    logger.info("Want to build {}".format(names))
+    ctx.wanted_recipes = names[:]
+    graph = get_recipes_graph(names, ctx)
+    history = BuildHistory(join(user_cache_dir, "durations.json"))
+    weights = history.get_weights(graph.graph)
+    for name in graph.graph:
+        if Recipe.get_recipe(name, ctx).is_alias:
+            weights[name] = 0
+    # start the longest chains of recipes first, among the ones ready
+    priority = graph.critical_path(weights)
+    build_order = list(graph.find_order(priority))
     logger.info("Build order is {}".format(build_order))
+    logger.debug("Recipes that can be built in parallel: {}".format(
+        graph.layers()))
     recipes = [Recipe.get_recipe(name, ctx) for name in build_order]
     recipes = [recipe for recipe in recipes if not recipe.is_alias]
     recipes_order = [recipe.name for recipe in recipes]
     logger.info("Recipe order is {}".format(recipes_order))
     for recipe in recipes:
         recipe.init_with_ctx(ctx)
+    if history.durations:
+        for name in graph.graph:
+            if "{}.build_all".format(name) in ctx.state:
+                weights[name] = 0
+        estimate = estimate_build_time(graph, weights, ctx.jobs)
+        if estimate:
+            logger.info("Estimated build time: {:.0f} min, done around {:%H:%M}".format(
+                estimate / 60., datetime.now() + timedelta(seconds=estimate)))
+    BuildTrace.start(ctx)
+    try:
+        if ctx.jobs > 1:
+            execute_recipes_parallel(graph, build_order, ctx)
+        else:
+            for recipe in recipes:
+                recipe.execute()
+    finally:
+        BuildTrace.export(ctx)
+        logger.info("Build trace written to {}".format(
+            join(ctx.build_dir, "trace.json")))
+        history.record_trace(BuildTrace.load(BuildTrace.filename))
+        history.save()
+
+
+def execute_recipes_parallel(graph, build_order, ctx):
+    """Execute the recipes, up to `ctx.jobs` at the same time.
+
+    A recipe is started as soon as all of its dependencies are done, in the
+    `build_order` priority. After the first failure no new recipe is started:
+    the running ones are waited for, so their state is recorded, then the
+    build stops.
+    """
+    from multiprocessing.connection import wait
+    logger.info("Building with up to {} recipes in parallel".format(ctx.jobs))
+    pending = list(build_order)
+    done = set()
+    running = {}
+    failed = []
+    while pending or running:
+        if not failed:
+            for name in pending[:]:
+                if len(running) >= ctx.jobs:
+                    break
+                if not graph.graph[name] <= done:
+                    continue
+                pending.remove(name)
+                recipe = Recipe.get_recipe(name, ctx)
+                if recipe.is_alias:
+                    done.add(name)
+                    continue
+                logger.info("Start {}".format(recipe.name))
+                job = ForkedJob(ctx, recipe.name, recipe.execute)
+                job.start()
+                running[job.conn] = (name, job)
+        if not running:
+            break
+        for conn in wait(list(running)):
+            name, job = running.pop(conn)
+            if job.join():
+                logger.info("Done {}".format(job.name))
+                done.add(name)
+            else:
+                logger.error("Failed {}".format(job.name))
+                failed.append(job.name)
+    if failed:
+        logger.error("Build stopped, failed recipes: {}".format(
+            ", ".join(failed)))
+        sys.exit(1)
+
+
+class DownloadProgress:
+    """Aggregated progress of concurrent downloads, on a single line"""
+
+    def __init__(self, count):
+        self.count = count
+        self.done = 0
+        self.sizes = {}
+        self.lock = threading.Lock()
+
+    def report_hook(self, name):
+        def _report_hook(received, size):
+            with self.lock:
+                self.sizes[name] = (received, size)
+                self.show()
+        return _report_hook
+
+    def finish(self, name):
+        with self.lock:
+            self.done += 1
+            self.show()
+
+    def show(self):
+        received = sum(
+            min(read, size) if size > 0 else read
+            for read, size in self.sizes.values())
+        stdout.write('- Fetch {}/{} done, {:.1f} MB received\r'.format(
+            self.done, self.count, received / 1024. / 1024.))
+        stdout.flush()
+
+
+def fetch_recipes(names, ctx, jobs=4):
+    """Download the archives of the `names` recipes and all their
+    dependencies, up to `jobs` at the same time, so that a later build
+    doesn't need the network.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    graph = get_recipes_graph(names, ctx)
+    recipes = [Recipe.get_recipe(name, ctx) for name in graph.find_order()]
+    recipes = [recipe for recipe in recipes if not recipe.is_alias]
+    for recipe in recipes:
+        recipe.init_with_ctx(ctx)
+    to_download = [
+        recipe for recipe in recipes
+        if recipe.url and not recipe.custom_dir
+        and not exists(join(recipe.recipe_dir, recipe.url))
+        and not exists(recipe.archive_fn)]
+    logger.info("Fetching {} archives, {} already in the cache".format(
+        len(to_download), len(recipes) - len(to_download)))
+    progress = DownloadProgress(len(to_download))
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                recipe.download_file,
+                recipe.url.format(version=recipe.version),
+                recipe.archive_fn,
+                report_hook=progress.report_hook(recipe.name),
+                sha256=recipe.sha256): recipe
+            for recipe in to_download}
+        for future in as_completed(futures):
+            recipe = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error("Failed to fetch {}: {}".format(recipe.name, e))
+                failed.append(recipe.name)
+            else:
+                progress.finish(recipe.name)
+    stdout.write("\n")
+    # the archives are there, only record their root dir
     for recipe in recipes:
-        recipe.execute()
+        if recipe.name not in failed:
+            recipe.download()
+    if failed:
+        logger.error("Unable to fetch {}".format(", ".join(failed)))
+        sys.exit(1)
 
 
 def ensure_dir(filename):
     makedirs(filename, exist_ok=True)
 
 
+_clone_flags = ["-c"] if sys.platform == "darwin" else ["--reflink=always"]
+
+
+def clone_tree(src, dest):
+    """Copy the tree `src` into `dest` (that must not exist). On APFS (or
+    btrfs/xfs), the files are cloned: they share their blocks with `src`
+    until one of the copies is written. Elsewhere, a regular copy is done.
+    """
+    global _clone_flags
+    if _clone_flags:
+        try:
+            sh.cp("-R", "-p", *_clone_flags, src, dest)
+            return
+        except sh.ErrorReturnCode:
+            logger.debug("The filesystem doesn't support clones, copying")
+            _clone_flags = None
+            shutil.rmtree(dest, ignore_errors=True)
+    if isdir(src) and not islink(src):
+        shutil.copytree(src, dest, symlinks=True)
+    else:
+        shutil.copy2(src, dest, follow_symlinks=False)
+
+
 def ensure_recipes_loaded(ctx):
     for recipe in Recipe.list_recipes():
         key = "{}.build_all".format(recipe)
@@ -1189,6 +3042,9 @@ def _hostpython_pip(args):
 
 
 def update_pbxproj(filename, pbx_frameworks=None):
+    from pbxproj import XcodeProject
+    from pbxproj.pbxextensions.ProjectFiles import FileOptions
+
     # list all the compiled recipes
     ctx = Context()
     pbx_libraries = []
@@ -1226,7 +3082,7 @@ def update_pbxproj(filename, pbx_frameworks=None):
     logger.info("Analysis of {}".format(filename))
 
     project = XcodeProject.load(filename)
-    sysroot = sh.xcrun("--sdk", "iphonesimulator", "--show-sdk-path").strip()
+    sysroot = ctx.sdk_paths["iphonesimulator"]
 
     group = project.get_or_create_group("Frameworks")
     g_classes = project.get_or_create_group("Classes")
@@ -1271,11 +3127,13 @@ class ToolchainCL:
 Available commands:
 build         Build a recipe (compile a library for the required target
               architecture)
+fetch         Download the sources of recipes and their dependencies
 clean         Clean the build of the specified recipe
 distclean     Clean the build and the result
 recipes       List all the available recipes
 status        List all the recipes and their build status
 build_info    Display the current build context and Architecture info
+profile       Show where the time of the last build was spent
 
 Xcode:
 create        Create a new xcode project
@@ -1283,8 +3141,14 @@ update        Update an existing xcode project (frameworks, libraries..)
 launchimage   Create Launch images for your xcode project
 icon          Create Icons for your xcode project
 pip           Install a pip dependency into the distribution
+
+The toolchain (SDKs, tools location) is probed once and cached, add
+--reprobe to any command to probe it again.
 """)
         parser.add_argument("command", help="Command to run")
+        if "--reprobe" in sys.argv:
+            sys.argv.remove("--reprobe")
+            Context.reprobe = True
         args = parser.parse_args(sys.argv[1:2])
         if not hasattr(self, args.command):
             print('Unrecognized command')
@@ -1313,6 +3177,23 @@ pip           Install a pip dependency into the distribution
                             help="Restrict compilation to this arch")
         parser.add_argument("--concurrency", type=int, default=ctx.num_cores,
                             help="number of concurrent build processes (where supported)")
+        parser.add_argument("--jobs", "-j", type=int, default=1,
+                            help="number of recipes to build in parallel")
+        parser.add_argument("--parallel-archs", action="store_true",
+                            help="build all the archs of a recipe at the same time")
+        parser.add_argument("--download-connections", type=int,
+                            default=ctx.download_connections,
+                            help="number of connections used to download a large archive")
+        parser.add_argument("--compress-logs", action="store_true",
+                            help="gzip the logs written in build/logs")
+        parser.add_argument("--no-binary-cache", action="store_true",
+                            help="do not restore nor store recipes in the binary cache")
+        parser.add_argument("--rebuild", action="store_true",
+                            help="build the recipes and the ones depending on them from scratch")
+        parser.add_argument("--remote-cache", default=ctx.binary_cache.remote_url,
+                            help="URL of an HTTP server to fetch prebuilt recipes from")
+        parser.add_argument("--remote-cache-upload", action="store_true",
+                            help="upload the recipes built to the remote cache (HTTP PUT)")
         parser.add_argument("--no-pigz", action="store_true", default=not bool(ctx.use_pigz),
                             help="do not use pigz for gzip decompression")
         parser.add_argument("--no-pbzip2", action="store_true", default=not bool(ctx.use_pbzip2),
@@ -1335,11 +3216,17 @@ pip           Install a pip dependency into the distribution
             ctx.archs = [arch for arch in ctx.archs if arch.arch in archs]
             logger.info("Architectures restricted to: {}".format(archs))
         ctx.num_cores = args.concurrency
+        ctx.jobs = max(1, args.jobs)
+        ctx.parallel_archs = args.parallel_archs
+        BuildLog.compress = args.compress_logs
+        ctx.use_binary_cache = not args.no_binary_cache
+        ctx.download_connections = max(1, args.download_connections)
+        ctx.binary_cache.remote_url = args.remote_cache
+        ctx.binary_cache.upload = args.remote_cache_upload
         if args.no_pigz:
             ctx.use_pigz = False
         if args.no_pbzip2:
             ctx.use_pbzip2 = False
-        ctx.use_pigz = ctx.use_pbzip2
         logger.info("Building with {} processes, where supported".format(ctx.num_cores))
         if ctx.use_pigz:
             logger.info("Using pigz to decompress gzip data")
@@ -1351,8 +3238,31 @@ pip           Install a pip dependency into the distribution
                 ctx.custom_recipes_paths.append(custom_recipe_path)
             else:
                 logger.error(f"{custom_recipe_path} isn't a valid path")
+        if args.rebuild:
+            ctx.rebuild.update(clean_recipes(args.recipe, ctx))
         build_recipes(args.recipe, ctx)
 
+    def fetch(self):
+        ctx = Context()
+        parser = argparse.ArgumentParser(
+                description="Download the sources of recipes and their dependencies")
+        parser.add_argument("recipe", nargs="+", help="Recipe to fetch")
+        parser.add_argument("--jobs", "-j", type=int, default=4,
+                            help="number of concurrent downloads")
+        parser.add_argument("--download-connections", type=int,
+                            default=ctx.download_connections,
+                            help="number of connections used to download a large archive")
+        parser.add_argument("--add-custom-recipe", action="append", default=[],
+                            help="Path to custom recipe")
+        args = parser.parse_args(sys.argv[2:])
+        ctx.download_connections = max(1, args.download_connections)
+        for custom_recipe_path in args.add_custom_recipe:
+            if exists(custom_recipe_path):
+                ctx.custom_recipes_paths.append(custom_recipe_path)
+            else:
+                logger.error(f"{custom_recipe_path} isn't a valid path")
+        fetch_recipes(args.recipe, ctx, jobs=max(1, args.jobs))
+
     def recipes(self):
         parser = argparse.ArgumentParser(
                 description="List all the available recipes")
@@ -1376,23 +3286,31 @@ pip           Install a pip dependency into the distribution
             recipe_inst = Recipe.get_recipe(recipe, ctx)
             recipe_inst.ctx = ctx
             if exists(recipe_inst.archive_fn):
+                shutil.rmtree(recipe_inst.pristine_dir, ignore_errors=True)
                 unlink(recipe_inst.archive_fn)
+            with suppress(FileNotFoundError):
+                unlink("{}.index.json".format(recipe_inst.archive_fn))
 
         parser = argparse.ArgumentParser(
                 description="Clean the build")
         parser.add_argument("recipe", nargs="*", help="Recipe to clean")
+        parser.add_argument("--add-custom-recipe", action="append", default=[],
+                            help="Path to custom recipe")
         args = parser.parse_args(sys.argv[2:])
         ctx = Context()
+        for custom_recipe_path in args.add_custom_recipe:
+            if exists(custom_recipe_path):
+                ctx.custom_recipes_paths.append(custom_recipe_path)
+            else:
+                logger.error(f"{custom_recipe_path} isn't a valid path")
         if args.recipe:
+            clean_recipes(args.recipe, ctx)
             for recipe in args.recipe:
-                logger.info("Cleaning {} build".format(recipe))
-                ctx.state.remove_all("{}.".format(recipe))
-                build_dir = join(ctx.build_dir, recipe)
-                shutil.rmtree(build_dir, ignore_errors=True)
                 clean_cache(recipe, ctx)
         else:
             logger.info("Delete build directory")
             shutil.rmtree(ctx.build_dir, ignore_errors=True)
+        prune_sources(ctx)
 
     def distclean(self):
         ctx = Context()
@@ -1413,6 +3331,25 @@ pip           Install a pip dependency into the distribution
             print("{:<12} - {}".format(
                 recipe, status))
 
+    def profile(self):
+        parser = argparse.ArgumentParser(
+                description="Show where the time of the last build was spent")
+        parser.add_argument("--limit", type=int, default=10,
+                            help="number of steps and commands to show")
+        args = parser.parse_args(sys.argv[2:])
+        ctx = Context()
+        filename = join(ctx.build_dir, "trace.jsonl")
+        if not exists(filename):
+            logger.error("No build trace found, run a build first")
+            sys.exit(1)
+        summary = BuildTrace.summarize(BuildTrace.load(filename))
+        print("Total: {:.1f}s".format(summary["seconds"]))
+        for title in ("recipes", "steps", "commands"):
+            print("\nSlowest {}:".format(title))
+            for item in summary[title][:args.limit]:
+                print("{:>9.1f}s  {:<16} {}".format(
+                    item["seconds"], item["recipe"] or "", item["name"][:100]))
+
     def create(self):
         parser = argparse.ArgumentParser(
                 description="Create a new xcode project")
@@ -1483,7 +3420,7 @@ pip           Install a pip dependency into the distribution
             print("\narch: {}\n{}".format(str(arch), ul))
             for attr in dir(arch):
                 if not attr.startswith("_"):
-                    if not callable(attr) and attr not in ['arch', 'ctx', 'get_env']:
+                    if not callable(attr) and attr not in ['arch', 'ctx', 'get_env', 'invalidate_env']:
                         print("{}: {}".format(attr, pformat(getattr(arch, attr))))
             env = arch.get_env()
             print("env ({}): {}".format(arch, pformat(env)))
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""
+Run `setup.py build_ext <args>` without compiling anything.
+
+build_extension() is replaced by a no-op, so everything the setup.py and its
+build_ext command generate before compiling (config headers, .pxi includes)
+is written, and the extensions are then compiled only once, after
+cythonization.
+"""
+
+import os
+import sys
+import runpy
+
+
+def skip_extension(self, ext):
+    print('configure only, not building', ext.name)
+
+
+def patch_build_ext():
+    try:
+        from setuptools.command.build_ext import build_ext
+        build_ext.build_extension = skip_extension
+    except ImportError:
+        pass
+    # setuptools may provide its own distutils, import it after setuptools
+    from distutils.command.build_ext import build_ext
+    build_ext.build_extension = skip_extension
+
+
+if __name__ == '__main__':
+    print('-- configure build_ext', sys.argv)
+    patch_build_ext()
+    sys.argv = ['setup.py', 'build_ext'] + sys.argv[1:]
+    # like `python setup.py`, so that setup.py can import its own tree
+    sys.path.insert(0, os.path.dirname(os.path.abspath('setup.py')))
+    runpy.run_path('setup.py', run_name='__main__')
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
 import os
+import re
 import sys
+import shutil
 import subprocess
 
 # resolve cython executable
@@ -10,49 +12,100 @@ cython = None
 
 def resolve_cython():
     global cython
+    if cython is not None:
+        return cython
     for executable in ('cython', 'cython-2.7'):
-        for path in os.environ['PATH'].split(':'):
-            if not os.path.exists(path):
-                continue
-            if executable in os.listdir(path):
-                cython = os.path.join(path, executable)
-                return
+        cython = shutil.which(executable)
+        if cython:
+            return cython
 
 
-def do(fn):
-    print('cythonize:', fn)
-    assert(fn.endswith('.pyx'))
+def get_modname(fn):
+    assert fn.endswith('.pyx')
     parts = fn.split('/')
     if parts[0] == '.':
         parts.pop(0)
     modname = parts[-1][:-4]
     package = '_'.join(parts[:-1])
+    return package, modname.split('.')[-1]
 
-    # cythonize
-    subprocess.Popen([cython, fn], env=os.environ).communicate()
 
+def rewrite(fn, package, modname):
+    """Rename the module init functions of the generated .c to include the
+    package, in a single pass over the file.
+    """
     if not package:
         print('no need to rewrite', fn)
-    else:
-        # get the .c, and change the initXXX
-        fn_c = fn[:-3] + 'c'
-        with open(fn_c) as fd:
-            data = fd.read()
-        modname = modname.split('.')[-1]
-        pac_mod = '{}_{}'.format(package, modname)
-        fmts = ('init{}(void)', 'PyInit_{}(void)', 'Pyx_NAMESTR("{}")', '"{}",')
-        for i, fmt in enumerate(fmts):
-            pat = fmt.format(modname)
-            sub = fmt.format(pac_mod)
-            print('{}: {} -> {}'.format(i + 1, pat, sub))
-            data = data.replace(pat, sub)
-        print('rewrite', fn_c)
-        with open(fn_c, 'w') as fd:
-            fd.write(data)
+        return
+    # get the .c, and change the initXXX
+    fn_c = fn[:-3] + 'c'
+    pac_mod = '{}_{}'.format(package, modname)
+    fmts = ('init{}(void)', 'PyInit_{}(void)', 'Pyx_NAMESTR("{}")', '"{}",')
+    subs = {}
+    for i, fmt in enumerate(fmts):
+        pat = fmt.format(modname)
+        sub = fmt.format(pac_mod)
+        print('{}: {} -> {}'.format(i + 1, pat, sub))
+        subs[pat.encode('utf-8')] = sub.encode('utf-8')
+    pattern = re.compile(b'|'.join(re.escape(pat) for pat in subs))
+    with open(fn_c, 'rb') as fd:
+        data = fd.read()
+    data, count = pattern.subn(lambda match: subs[match.group(0)], data)
+    print('rewrite', fn_c, '({} replacements)'.format(count))
+    with open(fn_c, 'wb') as fd:
+        fd.write(data)
+
+
+def compile_in_process(fns):
+    """Compile all the `fns` with the Cython module of this interpreter.
+    Return the files compiled successfully.
+    """
+    from Cython.Compiler.Main import (
+        compile_multiple, CompilationOptions, default_options)
+    options = CompilationOptions(default_options)
+    compiled = []
+    for fn in fns:
+        try:
+            results = compile_multiple([fn], options)
+        except Exception as e:
+            print('cython error:', fn, e)
+            continue
+        result = results.get(os.path.abspath(fn))
+        if result is not None and not result.num_errors:
+            compiled.append(fn)
+    return compiled
+
+
+def compile_executable(fns):
+    """Compile the `fns` with the cython executable, one process per file.
+    Return the files compiled successfully.
+    """
+    compiled = []
+    for fn in fns:
+        if subprocess.call([resolve_cython(), fn], env=os.environ) == 0:
+            compiled.append(fn)
+    return compiled
+
+
+def do(fns):
+    for fn in fns:
+        print('cythonize:', fn)
+    try:
+        import Cython  # noqa: F401
+        compiled = compile_in_process(fns)
+    except ImportError:
+        compiled = compile_executable(fns)
+    failed = []
+    for fn in fns:
+        if fn not in compiled:
+            failed.append(fn)
+            continue
+        package, modname = get_modname(fn)
+        rewrite(fn, package, modname)
+    if failed:
+        sys.exit('cythonize failed: {}'.format(' '.join(failed)))
 
 
 if __name__ == '__main__':
     print('-- cythonize', sys.argv)
-    resolve_cython()
-    for fn in sys.argv[1:]:
-        do(fn)
+    do(sys.argv[1:])